@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Content addressed cache of rendered audio.
+
+Rendered files are stored on disk, named after a hash of the normalized
+text and of every setting used to render them, and evicted in least
+recently used order once the cache grows over its size limit.
+For each entry we also remember the telegram file_id we got back from the
+first upload so next time the same audio can be sent by id, with no
+rendering and no upload at all.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from os import remove
+import hashlib
+import json
+import os
+import shutil
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class audiocache():
+    def __init__(self, directory='audiocache', max_bytes=100*2**20,
+                 max_file_ids=10000):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._max_file_ids = max_file_ids
+        self._lock = Lock()
+        self._files = OrderedDict()     # key -> size, oldest first
+        self._file_ids = OrderedDict()  # key -> telegram file_id
+        self._bytes = 0
+        self.hits = 0
+        self.file_id_hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+        # recover files left by a previous run, oldest first
+        entries = []
+        for name in os.listdir(directory):
+            if name.endswith('.mp3'):
+                st = os.stat(os.path.join(directory, name))
+                entries.append((st.st_mtime, name[:-4], st.st_size))
+            elif name.endswith('.tmp'):
+                # partially written by a crashed run
+                remove(os.path.join(directory, name))
+        for mtime, key, size in sorted(entries):
+            self._files[key] = size
+            self._bytes += size
+        self._evict()
+
+    @staticmethod
+    def key(text: str, **settings):
+        """ Return the cache key for text rendered with given settings """
+        text = ' '.join(text.split())
+        data = json.dumps([text, settings], sort_keys=True)
+        return hashlib.sha256(data.encode('utf8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self._directory, key + '.mp3')
+
+    def _evict(self):
+        # always called with lock held (or from __init__)
+        while self._bytes > self._max_bytes and self._files:
+            key, size = self._files.popitem(last=False)
+            self._bytes -= size
+            try:
+                remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def file_id(self, key):
+        """ Return telegram file_id for key or None """
+        with self._lock:
+            file_id = self._file_ids.get(key)
+            if file_id is not None:
+                self._file_ids.move_to_end(key)
+                self.file_id_hits += 1
+            return file_id
+
+    def set_file_id(self, key, file_id):
+        with self._lock:
+            self._file_ids[key] = file_id
+            self._file_ids.move_to_end(key)
+            while len(self._file_ids) > self._max_file_ids:
+                self._file_ids.popitem(last=False)
+
+    def open(self, key):
+        """ Return an open binary file for key or None if not cached
+
+        File is opened with the lock held so a concurrent eviction can't
+        remove it under our feet
+        """
+        with self._lock:
+            if key in self._files:
+                try:
+                    f = open(self._path(key), 'rb')
+                except FileNotFoundError:
+                    self._bytes -= self._files.pop(key)
+                else:
+                    # mtime keeps lru order across restarts
+                    os.utime(self._path(key))
+                    self._files.move_to_end(key)
+                    self.hits += 1
+                    return f
+            self.misses += 1
+            return None
+
+    def put(self, key, audio):
+        """ Store rendered audio file object in cache and return it rewound
+
+        Audio is copied to a temporary file in cache directory then
+        atomically renamed so nobody can read a partially written entry
+        """
+        path = self._path(key)
+        temppath = path + '.%x.tmp' % id(audio)
+        audio.seek(0)
+        with open(temppath, 'wb') as f:
+            shutil.copyfileobj(audio, f)
+            size = f.tell()
+        audio.seek(0)
+        with self._lock:
+            os.replace(temppath, path)
+            if key in self._files:
+                self._bytes -= self._files[key]
+            self._files[key] = size
+            self._files.move_to_end(key)
+            self._bytes += size
+            self._evict()
+        return audio
+
+    @property
+    def stats(self):
+        with self._lock:
+            hits = self.hits + self.file_id_hits
+            lookups = hits + self.misses
+            return {
+                'hits': self.hits,
+                'file_id_hits': self.file_id_hits,
+                'misses': self.misses,
+                'hit_ratio': hits / lookups if lookups else 0.0,
+                'entries': len(self._files),
+                'bytes': self._bytes,
+                'file_ids': len(self._file_ids),
+            }
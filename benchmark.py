@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Benchmarks for text2cw bot hot paths.
+
+Run from repository directory, everything is offline: news are read from
+a feed recorded in fixtures. With --json the results are also written as
+a report that --compare can check against the one of another release.
+"""
+
+from random import seed
+import io
+import json
+import platform
+import re
+import subprocess
+import time
+
+from parole import dizionario, anagrammi_cache
+from text2cw_bot import DEFAULTS, Settings, gen_groups, gen_groups_batch, \
+    get_feed, convert_numbers, simplify_text, translate_accents, \
+    create_exercise_pdf
+from feedcache import feedcache
+import migrations
+
+FEED = 'fixtures/news.xml'
+
+
+# Koch method order, lessons add one char at a time
+KOCH = "KMURESNAPTLWI.JZ=FOY,VG5/Q92H38B?47C1D60X"
+KOCH_LESSONS = [6, 12, 20, 30, len(KOCH)]
+
+
+def anagrammi_regex(parole, parola: str, minl=None, maxl=None):
+    # dizionario.anagrammi before the bitmask index, used as reference
+    chars = ''.join(set(parola)).upper()
+    mi = '%i' % minl if minl is not None else ''
+    ma = '%i' % maxl if maxl is not None else ''
+
+    regexp = '^[%s]{%s,%s}$' % (re.escape(chars), mi, ma)
+    r = re.compile(regexp)
+
+    return [p for p in parole if r.match(p)]
+
+
+def timeit(fn, *args, repeat=5, **kwargs):
+    """ Return best time (s) of repeat runs and last result """
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def record(name, seconds, **params):
+    """ One report entry, seconds is the best time of a single call """
+    return dict(name=name, seconds=seconds, **params)
+
+
+def bench_anagrammi(repeat=5):
+    results = []
+    print("%-14s %-6s %8s %10s %10s %10s %8s" % (
+          "dictionary", "lesson", "found", "regex ms", "index ms",
+          "cached ms", "speedup"))
+    for filename, minl, maxl in (('it.txt', 2, 10),
+                                 ('callsigns.txt', None, None)):
+        d = dizionario(filename, cache=None)
+        cached = dizionario(filename, cache=anagrammi_cache())
+        parole = list(d.parole)
+        for n in KOCH_LESSONS:
+            charset = KOCH[:n]
+            t_regex, expected = timeit(anagrammi_regex, parole, charset,
+                                       minl=minl, maxl=maxl, repeat=repeat)
+            t_index, found = timeit(d.anagrammi, charset,
+                                    minl=minl, maxl=maxl, repeat=repeat)
+            assert sorted(found) == sorted(expected)
+            t_cached, found = timeit(cached.anagrammi, charset,
+                                     minl=minl, maxl=maxl, repeat=repeat)
+            print("%-14s %-6i %8i %10.2f %10.2f %10.4f %7.1fx" % (
+                  filename, n, len(found), t_regex * 1000, t_index * 1000,
+                  t_cached * 1000, t_regex / t_index))
+            name = 'anagrammi/%s/%i' % (filename, n)
+            results += [record(name + '/index', t_index, found=len(found)),
+                        record(name + '/cached', t_cached, found=len(found))]
+    return results
+
+
+# settings read by _reply_with_audio before Settings
+AUDIO_SETTINGS = ['wpm', 'effectivewpm', 'extra space', 'tone', 'snr', 'title',
+                  'format', 'qrq', 'simplify', 'no accents', 'waveform']
+
+
+def you_exist_defaults(user_data, username='@user'):
+    # bot._you_exist before schema versions, run at each message
+    if user_data and user_data['exist']:
+        for (key, value) in DEFAULTS.items():
+            if key not in user_data:
+                user_data[key] = value
+        if 'username' not in user_data:
+            user_data['username'] = username
+        if username is not None and user_data['username'] is None:
+            user_data['username'] = username
+        return True
+    return False
+
+
+def you_exist_version(user_data, username='@user'):
+    # bot._you_exist, defaults are only checked when migrating
+    if user_data and user_data['exist']:
+        if user_data.get(migrations.SCHEMA_KEY, 0) < migrations.latest():
+            raise ValueError("benchmark user must be migrated")
+        if user_data.get('username') is None:
+            user_data['username'] = username
+        return True
+    return False
+
+
+def render_user_data(user_data):
+    # worker reading live user_data
+    return [user_data[key] for key in AUDIO_SETTINGS]
+
+
+def render_settings(user_data):
+    # snapshot taken by dispatcher thread, read by worker
+    settings = Settings.of(user_data)
+    return [settings.wpm, settings.effectivewpm, settings.extra_space,
+            settings.tone, settings.snr, settings.title, settings.format,
+            settings.qrq, settings.simplify, settings.no_accents,
+            settings.waveform]
+
+
+def bench_settings(repeat=5, messages=100000):
+    results = []
+    user_data = dict(DEFAULTS, exist=True, username='@user')
+    migrations.migrate(user_data, DEFAULTS)
+    print("%-10s %14s %14s" % ("", "message us", "render job us"))
+    for name, message, render in (
+            ('before', you_exist_defaults, render_user_data),
+            ('after', you_exist_version, render_settings)):
+        t_message, result = timeit(
+            lambda: [message(user_data) for i in range(messages)],
+            repeat=repeat)
+        t_render, result = timeit(
+            lambda: [render(user_data) for i in range(messages)],
+            repeat=repeat)
+        print("%-10s %14.2f %14.2f" % (name, t_message / messages * 1e6,
+                                       t_render / messages * 1e6))
+        results += [record('settings/%s/message' % name, t_message / messages),
+                    record('settings/%s/render' % name, t_render / messages)]
+    return results
+
+
+def bench_groups(repeat=5, exercises=(1, 3, 100)):
+    results = []
+    print("%-8s %8s %10s %10s %14s %8s" % (
+          "charset", "groups", "exercises", "loop ms",
+          "batch ms/ex", "speedup"))
+    for n in (KOCH_LESSONS[0], len(KOCH)):
+        charset = KOCH[:n]
+        for k in (20, 60, 500):
+            seed('benchmark')
+            t_loop, groups = timeit(gen_groups, charset, k, repeat=repeat)
+            assert len(groups) == k
+            name = 'gen_groups/%i/%i' % (n, k)
+            results.append(record(name, t_loop))
+            for e in exercises:
+                t_batch, batch = timeit(gen_groups_batch, charset, k, e,
+                                        repeat=repeat)
+                assert len(batch) == e
+                print("%-8i %8i %10i %10.3f %14.4f %7.1fx" % (
+                      n, k, e, t_loop * 1000, t_batch / e * 1000,
+                      t_loop * e / t_batch))
+                results.append(record('%s/batch/%i' % (name, e),
+                                      t_batch / e))
+    return results
+
+
+def news_text():
+    """ All news of the fixture feed, the longest text /read_news sends """
+    return get_feed(FEED, last_n=0)
+
+
+def bench_text(repeat=5):
+    results = []
+    text = news_text()
+    print("%-18s %8s %10s" % ("", "chars", "ms"))
+    for name, fn in (('convert_numbers', convert_numbers),
+                     ('simplify_text', simplify_text),
+                     ('translate_accents', translate_accents)):
+        t, out = timeit(fn, text, repeat=repeat)
+        print("%-18s %8i %10.3f" % (name, len(text), t * 1000))
+        results.append(record('text/' + name, t, chars=len(text)))
+    return results
+
+
+def bench_feed(repeat=5):
+    results = []
+    # a long ttl so after the first call only formatting is measured
+    feeds = feedcache(ttl=3600)
+    get_feed(FEED, feeds=feeds)
+    print("%-18s %8s %10s" % ("", "news", "ms"))
+    for last_n in (1, 5, 0):
+        t_parse, text = timeit(get_feed, FEED, last_n, repeat=repeat)
+        t_format, cached = timeit(get_feed, FEED, last_n, feeds=feeds,
+                                  repeat=repeat)
+        assert cached == text
+        print("%-18s %8s %10.3f" % ("parse and format", last_n or 'all',
+                                    t_parse * 1000))
+        print("%-18s %8s %10.3f" % ("format (cached)", last_n or 'all',
+                                    t_format * 1000))
+        results += [record('get_feed/parse/%s' % (last_n or 'all'), t_parse),
+                    record('get_feed/format/%s' % (last_n or 'all'),
+                           t_format)]
+    return results
+
+
+def bench_pdf(repeat=3):
+    # what /groups_exercise sends: 3 exercises of 60 groups
+    seed('benchmark')
+    groups = gen_groups_batch(KOCH, 12*5, 3)
+
+    def pdf():
+        with io.BytesIO() as output:
+            create_exercise_pdf(groups, output, [20, 25], None, None, KOCH,
+                                'benchmark')
+            return output.tell()
+
+    t, size = timeit(pdf, repeat=repeat)
+    print("%-18s %8s %10s" % ("", "bytes", "ms"))
+    print("%-18s %8i %10.1f" % ("exercise pdf", size, t * 1000))
+    return [record('create_exercise_pdf/3x60', t, bytes=size)]
+
+
+BENCHMARKS = {
+    'anagrammi': bench_anagrammi,
+    'settings': bench_settings,
+    'groups': bench_groups,
+    'text': bench_text,
+    'feed': bench_feed,
+    'pdf': bench_pdf,
+}
+
+
+def report(results, repeat):
+    try:
+        version = subprocess.run(
+                    ['git', 'describe', '--always', '--dirty'],
+                    capture_output=True, text=True).stdout.strip()
+    except OSError:
+        version = None
+    return {
+        'version': version,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def compare(old, results):
+    """ Print time ratio of each result to the same one in old report """
+    before = {r['name']: r['seconds'] for r in old['results']}
+    print("%-40s %12s %12s %8s" % ("compared to %s" % old.get('version'),
+                                   "before ms", "now ms", "ratio"))
+    for r in results:
+        if r['name'] in before and before[r['name']]:
+            print("%-40s %12.4f %12.4f %7.2fx" % (
+                  r['name'], before[r['name']] * 1000, r['seconds'] * 1000,
+                  r['seconds'] / before[r['name']]))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    argp = argparse.ArgumentParser(description=__doc__)
+    argp.add_argument(
+            '-r', '--repeat', default=5, type=int,
+            help='Runs for each measure, best one is reported')
+    argp.add_argument(
+            '--json',
+            help='Write results to this file')
+    argp.add_argument(
+            '--compare',
+            help='Compare results with this report of a previous run')
+    argp.add_argument(
+            'benchmarks', nargs='*',
+            help='Benchmarks to run among %s, all if none given' % (
+                 ', '.join(BENCHMARKS)))
+    args = argp.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            argp.error('unknown benchmark %s' % name)
+
+    results = []
+    for name in args.benchmarks or BENCHMARKS:
+        print('== %s' % name)
+        results += BENCHMARKS[name](args.repeat)
+        print()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report(results, args.repeat), f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Build compiled (memory mapped) version of bot word lists.
+
+Run it again every time a word list is changed, a stale compiled file is
+ignored by the bot that falls back to the slower text loading.
+"""
+
+import time
+
+from parole import compile_dictionary
+
+WORD_LISTS = ['it.txt', 'callsigns.txt']
+
+
+if __name__ == "__main__":
+    import argparse
+
+    argp = argparse.ArgumentParser(description=__doc__)
+    argp.add_argument('filenames', nargs='*', default=WORD_LISTS,
+                      help='Word list files (default %s)' %
+                      ', '.join(WORD_LISTS))
+    args = argp.parse_args()
+
+    for filename in args.filenames:
+        start = time.perf_counter()
+        destination = compile_dictionary(filename)
+        print("%s -> %s in %.2fs" % (filename, destination,
+                                     time.perf_counter() - start))
@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" In process cw synthesizer.
+
+Generate the same audio ebook2cw would give us for a text but without
+spawning any process: the keyed waveform is built as numpy buffers and
+encoded to mp3 with lameenc (python binding to the same lame library
+ebook2cw uses).
+
+Supported settings mirror the ebook2cw options used by the bot:
+wpm (-w), effective wpm (-e), extra word space (-W), qrq (-Q), tone (-f),
+snr (-N) with noise bandwidth and center (-B, -C), waveform (-T) plus
+<XX> prosigns and |f |w |e |v |T |N inline commands.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+import io
+import re
+import time
+import numpy as np
+
+try:
+    import lameenc
+except ImportError:     # pragma: no cover
+    lameenc = None
+
+
+SAMPLERATE = 11025      # same as ebook2cw default
+BITRATE = 16            # kbps, same as ebook2cw default
+RISETIME = 50           # samples, same as ebook2cw default
+VOLUME = 0.7
+PADDING = 0.1           # seconds of silence at start and end
+CHUNK = 2**16           # samples encoded at once
+
+WAVEFORMS = ['sine', 'sawtooth', 'square']
+
+MORSE = {
+    'A': '.-', 'B': '-...', 'C': '-.-.', 'D': '-..', 'E': '.', 'F': '..-.',
+    'G': '--.', 'H': '....', 'I': '..', 'J': '.---', 'K': '-.-',
+    'L': '.-..', 'M': '--', 'N': '-.', 'O': '---', 'P': '.--.',
+    'Q': '--.-', 'R': '.-.', 'S': '...', 'T': '-', 'U': '..-', 'V': '...-',
+    'W': '.--', 'X': '-..-', 'Y': '-.--', 'Z': '--..',
+    '0': '-----', '1': '.----', '2': '..---', '3': '...--', '4': '....-',
+    '5': '.....', '6': '-....', '7': '--...', '8': '---..', '9': '----.',
+    '.': '.-.-.-', ',': '--..--', '?': '..--..', "'": '.----.',
+    '!': '-.-.--', '/': '-..-.', '(': '-.--.', ')': '-.--.-', '&': '.-...',
+    ':': '---...', ';': '-.-.-.', '=': '-...-', '+': '.-.-.', '-': '-....-',
+    '_': '..--.-', '"': '.-..-.', '$': '...-..-', '@': '.--.-.',
+    'À': '.--.-', 'Â': '.--.-', 'Ä': '.-.-', 'Ç': '-.-..', 'È': '.-..-',
+    'É': '..-..', 'Ì': '.---.', 'Ñ': '--.--', 'Ò': '---.', 'Ô': '---.',
+    'Ö': '---.', 'Ù': '..--', 'Ü': '..--',
+}
+
+_TOKENS = re.compile(r'\|([a-zA-Z])(-?\d+)|<([^<>\s]+)>|(\s+)|(.)', re.S)
+
+
+def tokenize(text: str):
+    """
+    Split text in (kind, value) tokens, kind being one of
+    'command', 'prosign', 'space' or 'char'
+
+    >>> list(tokenize('ab <AR>|w30 c'))
+    [('char', 'A'), ('char', 'B'), ('space', ' '), ('prosign', 'AR'), \
+('command', ('w', 30)), ('space', ' '), ('char', 'C')]
+    """
+    for m in _TOKENS.finditer(text):
+        command, value, prosign, space, char = m.groups()
+        if command:
+            yield ('command', (command, int(value)))
+        elif prosign:
+            yield ('prosign', prosign.upper())
+        elif space:
+            yield ('space', space)
+        else:
+            yield ('char', char.upper())
+
+
+def farnsworth_unit(wpm, effectivewpm):
+    """ Return length (s) of a space unit at effective speed """
+    if effectivewpm is None or effectivewpm <= 0 or effectivewpm >= wpm:
+        return 1.2 / wpm
+    # ARRL formula, total delay of a word spread over 19 units
+    return (60.0 / effectivewpm - 37.2 / wpm) / 19.0
+
+
+def _oscillator(phase, waveform):
+    if waveform == 1:
+        return 2 * np.mod(phase / (2 * np.pi), 1.0) - 1
+    s = np.sin(phase)
+    return np.sign(s) if waveform == 2 else s
+
+
+def _silence(n):
+    global _zeros
+    # renders run in parallel: read the shared buffer once, a concurrent
+    # grow replaces it but never changes the one we hold
+    zeros = _zeros
+    if len(zeros) < n:
+        zeros = np.zeros(max(n, 2 * len(zeros)), dtype=np.float32)
+        zeros.flags.writeable = False
+        if len(zeros) > len(_zeros):
+            _zeros = zeros
+    return zeros[:n]
+
+
+_zeros = np.zeros(0, dtype=np.float32)
+
+
+class tonebank():
+    """
+    Pre rendered dit, dah and characters for each set of render parameters
+
+    Parameters are (wpm, effectivewpm, tone, waveform, samplerate, volume),
+    buffers are read only and shared between threads, least recently used
+    parameters are evicted once the bank grows over max_bytes
+    """
+
+    def __init__(self, max_bytes=16*2**20):
+        self._max_bytes = max_bytes
+        self._lock = Lock()
+        self._entries = OrderedDict()   # params -> {codes: buffer}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _element(params, mark):
+        wpm, effectivewpm, tone, waveform, samplerate, volume = params
+        n = int(round(1.2 / wpm * samplerate * (3 if mark == '-' else 1)))
+        phase = np.arange(n) * (2 * np.pi * tone / samplerate)
+        buf = volume * _oscillator(phase, waveform)
+        # raised cosine keying ramps inside the element
+        r = min(max(int(RISETIME * samplerate / SAMPLERATE), 1), n // 2)
+        ramp = 0.5 - 0.5 * np.cos(np.linspace(0, np.pi, r, endpoint=False))
+        buf[:r] *= ramp
+        buf[n-r:] *= ramp[::-1]
+        return buf.astype(np.float32)
+
+    def _character(self, params, codes, elements):
+        wpm, effectivewpm, tone, waveform, samplerate, volume = params
+        gap = _silence(int(round(1.2 / wpm * samplerate)))
+        pieces = []
+        for code in codes:
+            for mark in code:
+                if pieces:
+                    pieces.append(gap)
+                pieces.append(elements[mark])
+        # character space is part of the character
+        unit = farnsworth_unit(wpm, effectivewpm) * samplerate
+        pieces.append(_silence(int(round(unit * 3))))
+        return np.concatenate(pieces)
+
+    def character(self, params, codes):
+        """ Return buffer for a character (or prosign) given as codes """
+        with self._lock:
+            entry = self._entries.get(params)
+            if entry is not None:
+                self._entries.move_to_end(params)
+                buf = entry.get(codes)
+                if buf is not None:
+                    self.hits += 1
+                    return buf
+            self.misses += 1
+            # dit and dah are stored in the same entry with mark as key
+            elements = {mark: entry.get(mark) for mark in '.-'} \
+                if entry is not None else {}
+
+        new = {mark: self._element(params, mark)
+               for mark in '.-' if elements.get(mark) is None}
+        elements.update(new)
+        new[codes] = buf = self._character(params, codes, elements)
+
+        with self._lock:
+            entry = self._entries.setdefault(params, {})
+            self._entries.move_to_end(params)
+            for k, b in new.items():
+                if k not in entry:
+                    b.flags.writeable = False
+                    entry[k] = b
+                    self._bytes += b.nbytes
+            while self._bytes > self._max_bytes and len(self._entries) > 1:
+                old_params, old = self._entries.popitem(last=False)
+                self._bytes -= sum(b.nbytes for b in old.values())
+        return buf
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self._entries), 'bytes': self._bytes}
+
+
+BANK = tonebank()
+
+
+class _keying():
+    """ Build the list of buffers making a keyed message """
+
+    def __init__(self, wpm, effectivewpm, extraspace, qrq, tone, snr,
+                 waveform, samplerate, bank):
+        self.wpm = wpm
+        self.effectivewpm = effectivewpm
+        self.extraspace = extraspace or 0
+        self.qrq = qrq
+        self.tone = tone
+        self.snr = snr
+        self.volume = VOLUME
+        self.waveform = waveform
+        self.samplerate = samplerate
+        self.bank = bank
+
+        self.position = 0
+        self.next_qrq = qrq * 60 * samplerate if qrq else None
+        # one entry per piece, all lists have the same length
+        self.pieces = []
+        self.volumes = []
+        self.snrs = []
+
+    def _piece(self, buf):
+        if len(buf) == 0:
+            return
+        self.pieces.append(buf)
+        self.volumes.append(self.volume)
+        self.snrs.append(np.nan if self.snr is None else self.snr)
+        self.position += len(buf)
+
+    @property
+    def unit(self):
+        return farnsworth_unit(self.wpm, self.effectivewpm) * self.samplerate
+
+    def command(self, command, value):
+        if command == 'f':
+            self.tone = value
+        elif command == 'w' and value > 0:
+            self.wpm = value
+        elif command == 'e':
+            self.effectivewpm = value if value > 0 else None
+        elif command == 'v':
+            self.volume = min(max(value, 0), 100) / 100
+        elif command == 'T' and 0 <= value < len(WAVEFORMS):
+            self.waveform = value
+        elif command == 'N':
+            self.snr = value
+
+    def symbols(self, codes):
+        """ Send a character (or a prosign) given as tuple of codes """
+        if not codes:
+            return
+        if self.next_qrq is not None and self.position >= self.next_qrq:
+            self.wpm += 1
+            self.next_qrq += self.qrq * 60 * self.samplerate
+        params = (self.wpm, self.effectivewpm, self.tone, self.waveform,
+                  self.samplerate, self.volume)
+        self._piece(self.bank.character(params, codes))
+
+    def space(self):
+        # a character space has already been sent after last char
+        self._piece(_silence(int(round(self.unit
+                                       * (4 + 7 * self.extraspace)))))
+
+    def padding(self):
+        self._piece(_silence(int(round(PADDING * self.samplerate))))
+
+
+def keying(text: str, wpm, effectivewpm=None, extraspace=None, qrq=None,
+           tone=600, snr=None, waveform=0, samplerate=SAMPLERATE, bank=None):
+    """ Parse text and return the _keying description """
+    k = _keying(wpm, effectivewpm, extraspace, qrq, tone, snr, waveform,
+                samplerate, bank if bank is not None else BANK)
+    k.padding()
+    for kind, value in tokenize(text):
+        if kind == 'command':
+            k.command(*value)
+        elif kind == 'space':
+            k.space()
+        elif kind == 'prosign':
+            k.symbols(tuple(MORSE[c] for c in value if c in MORSE))
+        elif value in MORSE:
+            k.symbols((MORSE[value], ))
+    k.padding()
+    return k
+
+
+def bandpass(samples, samplerate, bandwidth, center):
+    """ Ideal band pass filter applied in frequency domain """
+    spectrum = np.fft.rfft(samples)
+    freqs = np.fft.rfftfreq(len(samples), 1 / samplerate)
+    spectrum[np.abs(freqs - center) > bandwidth / 2] = 0
+    return np.fft.irfft(spectrum, len(samples))
+
+
+def synthesize(text: str, wpm, effectivewpm=None, extraspace=None, qrq=None,
+               tone=600, snr=None, bandwidth=500, center=None, waveform=0,
+               samplerate=SAMPLERATE, rng=None, bank=None):
+    """
+    Render text to cw audio, noise added for snr is limited to bandwidth
+    around center (tone if not given), the signal is not filtered
+
+        Returns:
+            samples (numpy.ndarray): float32 samples in -1..1 range
+
+    >>> rng = np.random.default_rng(1)
+    >>> for tone in (200, 400, 1200):
+    ...     s = synthesize('paris', 20, tone=tone, snr=0, rng=rng)
+    ...     f = np.fft.rfftfreq(len(s), 1 / SAMPLERATE)
+    ...     print(int(round(f[np.argmax(np.abs(np.fft.rfft(s)))], -1)))
+    200
+    400
+    1200
+    """
+    k = keying(text, wpm, effectivewpm, extraspace, qrq, tone, snr,
+               waveform, samplerate, bank)
+    # message is just the concatenation of pre rendered buffers
+    samples = np.concatenate(k.pieces)
+    lengths = np.fromiter((len(p) for p in k.pieces), dtype=np.int64,
+                          count=len(k.pieces))
+
+    snrs = np.asarray(k.snrs, dtype=np.float64)
+    if not np.all(np.isnan(snrs)):
+        # noise power is referred to the filter bandwidth so snr is the
+        # one you would hear, samples without noise get a zero sigma
+        rng = rng if rng is not None else np.random.default_rng()
+        signal_power = np.repeat(np.asarray(k.volumes), lengths) ** 2 / 2
+        in_band = bandwidth / (samplerate / 2)
+        snr = np.repeat(snrs, lengths)
+        sigma = np.sqrt(signal_power / 10 ** (np.nan_to_num(snr) / 10)
+                        / in_band)
+        sigma[np.isnan(snr)] = 0
+        noise = bandpass(rng.standard_normal(len(samples)) * sigma,
+                         samplerate, bandwidth,
+                         center if center is not None else tone)
+        samples = samples + noise
+
+    peak = np.max(np.abs(samples)) if len(samples) else 0
+    if peak > 1:
+        samples /= peak
+    return samples.astype(np.float32)
+
+
+def _id3_frame(frame_id: str, text: str):
+    data = b'\x01' + text.encode('utf-16')
+    return frame_id.encode('ascii') + len(data).to_bytes(4, 'big') + \
+        b'\x00\x00' + data
+
+
+def id3_tag(title=None, artist=None):
+    """ Build a minimal ID3v2.3 tag with title and artist """
+    frames = b''
+    if title:
+        frames += _id3_frame('TIT2', title)
+    if artist:
+        frames += _id3_frame('TPE1', artist)
+    if not frames:
+        return b''
+    size = len(frames)
+    # tag size is a syncsafe integer (7 bits per byte)
+    syncsafe = bytes((size >> s) & 0x7f for s in (21, 14, 7, 0))
+    return b'ID3\x03\x00\x00' + syncsafe + frames
+
+
+def encode_mp3(samples, samplerate=SAMPLERATE, bitrate=BITRATE, title=None,
+               artist=None, output=None, deadline=None):
+    """
+    Encode float samples to mp3
+
+    Encoded data is streamed to output file object if given, otherwise it is
+    returned as bytes. TimeoutError is raised if encoding is still going on
+    at deadline (a time.monotonic() value)
+    """
+    if lameenc is None:
+        raise RuntimeError("lameenc is required to encode mp3")
+    encoder = lameenc.Encoder()
+    encoder.set_bit_rate(bitrate)
+    encoder.set_in_sample_rate(samplerate)
+    encoder.set_channels(1)
+    encoder.set_quality(2)
+    out = output if output is not None else io.BytesIO()
+    out.write(id3_tag(title, artist))
+    for i in range(0, len(samples), CHUNK):
+        if deadline is not None and time.monotonic() > deadline:
+            raise TimeoutError('mp3 encoding past deadline')
+        pcm = (np.clip(samples[i:i+CHUNK], -1, 1) * 32767).astype('<i2')
+        out.write(encoder.encode(pcm.tobytes()))
+    out.write(encoder.flush())
+    if output is None:
+        return out.getvalue()
+
+
+def available():
+    """ True if all libraries needed to render mp3 are installed """
+    return lameenc is not None
+
+
+def render(text: str, title=None, artist=None, output=None, deadline=None,
+           **settings):
+    """
+    Render text to mp3, settings are the synthesize() ones
+
+    Result is written to output file object if given, otherwise it is
+    returned as bytes. See encode_mp3() for deadline
+    """
+    samplerate = settings.get('samplerate', SAMPLERATE)
+    return encode_mp3(synthesize(text, **settings), samplerate,
+                      title=title, artist=artist, output=output,
+                      deadline=deadline)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" asyncio event loop running bot jobs in its own thread.
+
+Jobs are coroutines, while they wait for a subprocess, a download or an
+upload they hold no thread so many of them can be in flight at the same
+time. Blocking calls (the telegram library is synchronous) run on a small
+pool of I/O threads.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Thread, Lock
+import asyncio
+import contextvars
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+async def run_command(command, input=None):
+    """ Run command feeding it input, return its stdout """
+    process = await asyncio.create_subprocess_exec(
+                            *command,
+                            stdin=asyncio.subprocess.PIPE,
+                            stdout=asyncio.subprocess.PIPE)
+    try:
+        stdout, stderr = await process.communicate(input)
+    except asyncio.CancelledError:
+        # do not leave it running when we give up on it
+        if process.returncode is None:
+            process.kill()
+        raise
+    return stdout
+
+
+class engine():
+    def __init__(self, io_workers=8):
+        self._loop = asyncio.new_event_loop()
+        self._executor = ThreadPoolExecutor(max_workers=io_workers,
+                                            thread_name_prefix='io')
+        self._loop.set_default_executor(self._executor)
+        self._thread = None
+        self._lock = Lock()
+        self.in_flight = 0
+        self.done = 0
+        self.failed = 0
+
+    def start(self):
+        self._thread = Thread(target=self._loop.run_forever, daemon=True,
+                              name='engine')
+        self._thread.start()
+
+    def submit(self, coro, on_error=None):
+        """
+        Schedule coro on the loop from any thread, return a
+        concurrent.futures.Future of its result
+
+        on_error(exception) is called on an I/O thread if coro fails
+        """
+        with self._lock:
+            self.in_flight += 1
+        future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+        def done(future):
+            with self._lock:
+                self.in_flight -= 1
+                if future.cancelled() or future.exception() is None:
+                    self.done += 1
+                    return
+                self.failed += 1
+            if on_error is not None:
+                self._executor.submit(on_error, future.exception())
+            else:
+                logger.error(msg="Exception in job:",
+                             exc_info=future.exception())
+        future.add_done_callback(done)
+        return future
+
+    async def call(self, fn, *args, **kwargs):
+        """ Run blocking fn on an I/O thread, in the caller context """
+        context = contextvars.copy_context()
+        return await self._loop.run_in_executor(
+                        None, partial(context.run, fn, *args, **kwargs))
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': self.in_flight,
+                'done': self.done,
+                'failed': self.failed,
+            }
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        if self._thread is not None:
+            self._thread.join()
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Bounded queue of bot jobs, fair between users.
+
+At most running jobs run on the engine at the same time and each user has
+at most per_user of them running, the others wait in the queue. Waiting
+jobs are started round robin between users so a user asking for a lot of
+work can't delay everyone else. When capacity jobs are already waiting
+new ones are refused.
+"""
+
+from collections import OrderedDict, deque
+from threading import Lock
+import time
+
+
+class fairqueue():
+    def __init__(self, engine, running=16, per_user=2, capacity=200):
+        self._engine = engine
+        self._running = running
+        self._per_user = per_user
+        self._capacity = capacity
+        self._lock = Lock()
+        self._waiting = OrderedDict()   # user -> deque of waiting jobs
+        self._in_flight = {}            # user -> running jobs
+        self.depth = 0
+        self.started = 0
+        self.rejected = 0
+        self.total_wait = 0
+        self.max_wait = 0
+
+    def _position(self, user):
+        # jobs started before a new job of user, taking turns
+        mine = len(self._waiting.get(user, ())) + 1
+        return sum(min(len(jobs), mine)
+                   for other, jobs in self._waiting.items()
+                   if other != user) + mine
+
+    def submit(self, user, coro, on_error=None):
+        """
+        Run coro on the engine as soon as user gets its turn
+
+        Return 0 if coro started right away, its position in the queue if
+        it has to wait, None if the queue is full and coro was dropped
+        """
+        with self._lock:
+            if self._start_now(user):
+                job = self._start(user, coro, on_error, time.monotonic())
+                position = 0
+            elif self.depth >= self._capacity:
+                self.rejected += 1
+                job = position = None
+            else:
+                position = self._position(user)
+                self._waiting.setdefault(user, deque()).append(
+                                    (coro, on_error, time.monotonic()))
+                self.depth += 1
+                job = True
+        if job is None:
+            coro.close()    # never awaited
+        elif job is not True:
+            self._engine_submit(user, *job)
+        return position
+
+    def _start_now(self, user):
+        return sum(self._in_flight.values()) < self._running and \
+            self._in_flight.get(user, 0) < self._per_user and \
+            user not in self._waiting
+
+    def _start(self, user, coro, on_error, queued):
+        # with lock held, bookkeeping for a job leaving the queue
+        self._in_flight[user] = self._in_flight.get(user, 0) + 1
+        wait = time.monotonic() - queued
+        self.started += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        return coro, on_error
+
+    def _engine_submit(self, user, coro, on_error):
+        future = self._engine.submit(coro, on_error=on_error)
+        future.add_done_callback(lambda future: self._done(user))
+
+    def _next(self):
+        # with lock held, first waiting user allowed to run one more job
+        if sum(self._in_flight.values()) >= self._running:
+            return None
+        for user, jobs in self._waiting.items():
+            if self._in_flight.get(user, 0) < self._per_user:
+                job = jobs.popleft()
+                self.depth -= 1
+                if jobs:
+                    self._waiting.move_to_end(user)
+                else:
+                    del self._waiting[user]
+                return user, self._start(user, *job)
+        return None
+
+    def _done(self, user):
+        with self._lock:
+            self._in_flight[user] -= 1
+            if not self._in_flight[user]:
+                del self._in_flight[user]
+            ready = []
+            while True:
+                job = self._next()
+                if job is None:
+                    break
+                ready.append(job)
+        for user, job in ready:
+            self._engine_submit(user, *job)
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                'depth': self.depth,
+                'running': sum(self._in_flight.values()),
+                'users_waiting': len(self._waiting),
+                'started': self.started,
+                'rejected': self.rejected,
+                'avg_wait': self.total_wait / self.started
+                if self.started else 0,
+                'max_wait': self.max_wait,
+            }
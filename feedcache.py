@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Process wide cache of parsed RSS feeds.
+
+Each feed is downloaded and parsed at most once every ttl seconds, when it
+expires it is revalidated sending ETag/Last-Modified so an unchanged feed
+costs a 304 answer and no parsing at all.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+import time
+import logging
+
+import feedparser
+
+logger = logging.getLogger(__name__)
+
+
+class _entry():
+    def __init__(self):
+        self.lock = Lock()      # only one refresh at a time for each feed
+        self.feed = None
+        self.etag = None
+        self.modified = None
+        self.fetched = None
+
+
+class feedcache():
+    def __init__(self, ttl=300, max_feeds=100):
+        self.ttl = ttl
+        self._max_feeds = max_feeds
+        self._lock = Lock()
+        self._entries = OrderedDict()   # url -> _entry
+        self.hits = 0
+        self.not_modified = 0
+        self.fetches = 0
+
+    def _entry(self, url):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                entry = self._entries[url] = _entry()
+            self._entries.move_to_end(url)
+            while len(self._entries) > self._max_feeds:
+                self._entries.popitem(last=False)
+            return entry
+
+    def _fresh(self, entry):
+        return entry.feed is not None and \
+            time.monotonic() - entry.fetched < self.ttl
+
+    def get(self, url):
+        """ Return parsed feed, bozo set if it could not be read """
+        entry = self._entry(url)
+        if self._fresh(entry):
+            with self._lock:
+                self.hits += 1
+            return entry.feed
+
+        with entry.lock:
+            # somebody else may have refreshed it while we were waiting
+            if self._fresh(entry):
+                with self._lock:
+                    self.hits += 1
+                return entry.feed
+
+            parsed = feedparser.parse(url, etag=entry.etag,
+                                      modified=entry.modified)
+            if entry.feed is not None and parsed.get('status') == 304:
+                logger.debug('feed %s not modified' % url)
+                entry.fetched = time.monotonic()
+                with self._lock:
+                    self.not_modified += 1
+                return entry.feed
+
+            with self._lock:
+                self.fetches += 1
+            if parsed.bozo == 0:
+                entry.feed = parsed
+                entry.etag = parsed.get('etag')
+                entry.modified = parsed.get('modified')
+                entry.fetched = time.monotonic()
+            elif entry.feed is not None:
+                # better old news than no news
+                logger.warning('feed %s refresh failed, using cached copy'
+                               % url)
+                return entry.feed
+            return parsed
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                'feeds': len(self._entries),
+                'hits': self.hits,
+                'not_modified': self.not_modified,
+                'fetches': self.fetches,
+            }
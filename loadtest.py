@@ -0,0 +1,517 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Load test of text2cw bot against a fake Telegram Bot API.
+
+The bot runs in this process and polls updates from a local server that
+plays Telegram: simulated users send a mix of requests, each one waits
+for all its audio (and pdf) to be uploaded before sending the next one.
+With --stub ebook2cw and QSO are replaced by deterministic stubs so the
+load is the bot and not the renderer.
+
+Reports throughput, latency from update to first and last upload and
+resource usage. Run from repository directory, everything is offline.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Condition, Event
+import json
+import os
+import random
+import re
+import resource
+import stat
+import sys
+import tempfile
+import threading
+import time
+import logging
+
+TOKEN = '123456:LOADTEST'
+FEED = 'fixtures/news.xml'
+TIMEOUT = 120   # s a request can take before it is counted as lost
+
+ME = {'id': 1, 'is_bot': True, 'first_name': 'text2cw', 'username':
+      'text2cw_loadtest_bot'}
+
+# uploads of each request for a user with n speeds
+REQUESTS = {
+    'text': lambda n: n,
+    'word': lambda n: n,
+    'send_groups': lambda n: n,
+    'read_news': lambda n: n,
+    'groups_exercise': lambda n: 3 * n + 1,
+    'qso': lambda n: n,
+}
+
+TEXTS = [
+    "CQ CQ DE IZ3GME IZ3GME K",
+    "Il vento soffia forte stanotte sulla laguna di Venezia",
+    "RST 599 599 QTH Padova name Marco 73 e buoni DX",
+    "The quick brown fox jumps over the lazy dog 1234567890",
+    "Prova di trasmissione in telegrafia a velocità variabile",
+]
+
+STUB_EBOOK2CW = '''#!%(python)s
+# deterministic ebook2cw stand in: writes prefix0000.mp3, size and time
+# grow with text length
+import hashlib, sys, time
+args = sys.argv[1:]
+prefix = args[args.index('-o') + 1]
+text = sys.stdin.buffer.read()
+time.sleep(len(text) / %(speed)f)
+block = hashlib.sha256(text + args[args.index('-w') + 1].encode()).digest()
+with open(prefix + '0000.mp3', 'wb') as f:
+    # about the size of a 16 kbps mp3 at 20 wpm
+    f.write(block * (len(text) * 500 // len(block) + 1))
+'''
+
+STUB_QSO = '''#!%(python)s
+print("VVV DE IZ3GME = R DE IK3XYZ GM OM TNX FER CALL UR RST 599 "
+      "NAME MARCO QTH PADOVA = HW? AR IZ3GME DE IK3XYZ K")
+'''
+
+
+def write_stubs(directory, speed):
+    """ Write renderer stubs in directory, return ebook2cw and QSO paths """
+    paths = []
+    for name, source in (('ebook2cw', STUB_EBOOK2CW), ('QSO', STUB_QSO)):
+        path = os.path.join(directory, name)
+        with open(path, 'w') as f:
+            f.write(source % {'python': sys.executable, 'speed': speed})
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+        paths.append(path)
+    return paths
+
+
+class _chat():
+    def __init__(self):
+        self.uploads = []   # upload times
+        self.messages = []  # text of messages sent to chat
+
+
+class _handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, code, body, content_type='application/json'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/news.xml':
+            with open(self.server.api.feed, 'rb') as f:
+                return self._reply(200, f.read(), 'application/rss+xml')
+        self.do_POST()
+
+    def do_POST(self):
+        method = self.path.rsplit('/', 1)[-1]
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Type', '').startswith('multipart/'):
+            # files: only chat_id is needed
+            match = re.search(rb'name="chat_id"\r\n\r\n(-?\d+)', body)
+            params = {'chat_id': match.group(1).decode() if match else 0}
+        else:
+            params = json.loads(body) if body else {}
+        result = self.server.api.call(method, params, len(body))
+        self._reply(200, json.dumps({'ok': True, 'result': result}).encode())
+
+
+class fakeapi():
+    def __init__(self, listen='127.0.0.1', port=0, feed=FEED):
+        self.feed = feed
+        self._httpd = ThreadingHTTPServer((listen, port), _handler)
+        self._httpd.daemon_threads = True
+        self._httpd.api = self
+        self._cond = Condition()
+        self._updates = []
+        self._next_update = 1
+        self._next_message = 1
+        self._chats = {}
+        self._closing = False
+        self.uploaded_bytes = 0
+
+    @property
+    def url(self):
+        return 'http://%s:%i' % self._httpd.server_address[:2]
+
+    def start(self):
+        Thread(target=self._httpd.serve_forever, name='fakeapi',
+               daemon=True).start()
+
+    def close(self):
+        """ Answer pending and next getUpdates right away """
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def send(self, user, text):
+        """ Queue a message of user as an update, return when queued """
+        message = {
+            'message_id': self._next_message,
+            'date': int(time.time()),
+            'chat': {'id': user, 'type': 'private'},
+            'from': {'id': user, 'is_bot': False,
+                     'first_name': 'User%i' % user},
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0,
+                                    'length': len(text.split()[0])}]
+        with self._cond:
+            self._next_message += 1
+            self._updates.append({'update_id': self._next_update,
+                                  'message': message})
+            self._next_update += 1
+            self._cond.notify_all()
+        return time.monotonic()
+
+    def _get_updates(self, offset, timeout):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._updates = [u for u in self._updates
+                             if u['update_id'] >= offset]
+            while not self._updates and not self._closing:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self._cond.wait(left)
+            return list(self._updates)
+
+    def chat(self, user):
+        with self._cond:
+            return self._chats.setdefault(user, _chat())
+
+    def wait(self, user, predicate, timeout=TIMEOUT):
+        """ Wait until predicate(chat) is true, return it """
+        chat = self.chat(user)
+        with self._cond:
+            return self._cond.wait_for(lambda: predicate(chat), timeout)
+
+    def call(self, method, params, size):
+        if method == 'getUpdates':
+            return self._get_updates(int(params.get('offset') or 0),
+                                     float(params.get('timeout') or 0))
+        if method == 'getMe':
+            return ME
+        if not method.startswith('send') or method == 'sendChatAction':
+            return True
+
+        user = int(params.get('chat_id', 0))
+        with self._cond:
+            chat = self._chats.setdefault(user, _chat())
+            if method == 'sendMessage':
+                chat.messages.append(params.get('text', ''))
+            else:
+                chat.uploads.append(time.monotonic())
+                self.uploaded_bytes += size
+            self._next_message += 1
+            message_id = self._next_message
+            self._cond.notify_all()
+
+        message = {'message_id': message_id, 'date': int(time.time()),
+                   'chat': {'id': user, 'type': 'private'}, 'from': ME}
+        attachment = {'file_id': 'file%i' % message_id,
+                      'file_unique_id': 'unique%i' % message_id}
+        if method == 'sendVoice':
+            message['voice'] = dict(attachment, duration=1)
+        elif method == 'sendAudio':
+            message['audio'] = dict(attachment, duration=1)
+        elif method == 'sendDocument':
+            message['document'] = attachment
+        else:
+            message['text'] = params.get('text', '')
+        return message
+
+
+def request_text(command, rng):
+    if command == 'text':
+        return rng.choice(TEXTS)
+    if command == 'word':
+        return '/send_word %i' % rng.randint(1, 10)
+    return '/' + command
+
+
+def setup_user(api, user, wpm, feed):
+    """ Register user and its settings, return True if all went well """
+    for text, answer in (('/start', 'Hi '),
+                         ('/feed ' + feed, 'read news from'),
+                         ('/wpm ' + ','.join(map(str, wpm)), 'speed is now')):
+        seen = len(api.chat(user).messages)
+        api.send(user, text)
+        if not api.wait(user, lambda chat: any(
+                            answer in m for m in chat.messages[seen:])):
+            return False
+    return True
+
+
+def run_user(api, user, mix, wpm, feed, deadline, think, results):
+    rng = random.Random(user)
+    if not setup_user(api, user, wpm, feed):
+        results.append({'command': 'setup', 'status': 'timeout'})
+        return
+    commands, weights = zip(*mix.items())
+    while time.monotonic() < deadline:
+        command = rng.choices(commands, weights)[0]
+        expected = REQUESTS[command](len(wpm))
+        chat = api.chat(user)
+        uploads = len(chat.uploads)
+        messages = len(chat.messages)
+        sent = api.send(user, request_text(command, rng))
+
+        def done(chat):
+            return len(chat.uploads) >= uploads + expected or any(
+                'too busy' in m for m in chat.messages[messages:])
+
+        if not api.wait(user, done):
+            status = 'timeout'
+        elif len(chat.uploads) < uploads + expected:
+            status = 'rejected'
+        else:
+            status = 'ok'
+        result = {'command': command, 'status': status}
+        if status == 'ok':
+            result['first'] = chat.uploads[uploads] - sent
+            result['last'] = chat.uploads[uploads + expected - 1] - sent
+        results.append(result)
+        time.sleep(rng.uniform(0, 2 * think))
+
+
+def percentile(values, p):
+    """ Nearest rank percentile of sorted values """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values))
+                                                - 1))]
+
+
+class _monitor():
+    """ Sample threads and open files while the test runs """
+    def __init__(self, interval=0.5):
+        self._interval = interval
+        self._stop = Event()
+        self.threads = 0
+        self.files = 0
+        self._thread = Thread(target=self._run, name='monitor', daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self.threads = max(self.threads, threading.active_count())
+            try:
+                self.files = max(self.files, len(os.listdir('/proc/self/fd')))
+            except OSError:
+                pass
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def summary(results, elapsed, usage, monitor, api, stats):
+    ok = [r for r in results if r['status'] == 'ok']
+    report = {
+        'requests': len(results),
+        'ok': len(ok),
+        'rejected': sum(r['status'] == 'rejected' for r in results),
+        'timeout': sum(r['status'] == 'timeout' for r in results),
+        'seconds': elapsed,
+        'throughput': len(ok) / elapsed,
+        'commands': {},
+        'cpu_user': usage['cpu_user'],
+        'cpu_system': usage['cpu_system'],
+        'cpu_children': usage['cpu_children'],
+        'max_rss_mb': usage['max_rss_mb'],
+        'max_threads': monitor.threads,
+        'max_open_files': monitor.files,
+        'uploaded_mb': api.uploaded_bytes / 2**20,
+        'bot': stats,
+    }
+    for key in ('first', 'last'):
+        values = sorted(r[key] for r in ok)
+        for p in (50, 95, 99):
+            report['%s_p%i' % (key, p)] = percentile(values, p)
+    for command in sorted(set(r['command'] for r in results)):
+        mine = [r for r in results if r['command'] == command]
+        last = sorted(r['last'] for r in mine if r['status'] == 'ok')
+        report['commands'][command] = {
+            'requests': len(mine),
+            'ok': len(last),
+            'last_p50': percentile(last, 50),
+            'last_p95': percentile(last, 95),
+        }
+    return report
+
+
+def print_report(report):
+    def ms(value):
+        return '%8.0f' % (value * 1000) if value is not None else '       -'
+
+    print('requests %i: %i ok, %i rejected, %i timed out in %.1f s, '
+          '%.2f requests/s' % (report['requests'], report['ok'],
+                               report['rejected'], report['timeout'],
+                               report['seconds'], report['throughput']))
+    print('%-22s %8s %8s %8s' % ('latency ms', 'p50', 'p95', 'p99'))
+    for key, name in (('first', 'update to first upload'),
+                      ('last', 'update to last upload')):
+        print('%-22s %s %s %s' % (name, ms(report[key + '_p50']),
+                                  ms(report[key + '_p95']),
+                                  ms(report[key + '_p99'])))
+    print('%-22s %8s %8s %8s %8s' % ('command', 'requests', 'ok',
+                                     'p50 ms', 'p95 ms'))
+    for command, c in report['commands'].items():
+        print('%-22s %8i %8i %s %s' % (command, c['requests'], c['ok'],
+                                       ms(c['last_p50']), ms(c['last_p95'])))
+    print('cpu %.1f s user, %.1f s system, %.1f s renderers; max rss %.0f MB,'
+          ' max threads %i, max open files %i, uploaded %.1f MB' % (
+              report['cpu_user'], report['cpu_system'],
+              report['cpu_children'], report['max_rss_mb'],
+              report['max_threads'], report['max_open_files'],
+              report['uploaded_mb']))
+    for name, value in report['bot'].items():
+        print('%s %s' % (name, value))
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(','):
+        command, weight = item.split('=')
+        if command not in REQUESTS:
+            raise ValueError('unknown request %s' % command)
+        weights[command] = float(weight)
+    return weights
+
+
+if __name__ == "__main__":
+    import argparse
+
+    argp = argparse.ArgumentParser(description=__doc__)
+    argp.add_argument(
+            '-u', '--users', default=20, type=int,
+            help='Concurrent simulated users')
+    argp.add_argument(
+            '-t', '--duration', default=30, type=float,
+            help='Seconds users keep sending requests')
+    argp.add_argument(
+            '--mix',
+            default='text=50,word=20,send_groups=15,read_news=10,'
+                    'groups_exercise=5',
+            help='Weight of each request among %s' % ', '.join(REQUESTS))
+    argp.add_argument(
+            '--wpm', default='20,25',
+            help='Speeds of each user, one audio each')
+    argp.add_argument(
+            '--think', default=1, type=float,
+            help='Average seconds a user waits between requests')
+    argp.add_argument(
+            '--stub', action='store_true',
+            help='Render with deterministic ebook2cw and QSO stubs')
+    argp.add_argument(
+            '--stub-speed', default=5000, type=float,
+            help='Characters per second rendered by the ebook2cw stub')
+    argp.add_argument(
+            '-b', '--backend', default='cwsynth',
+            help='Audio rendering backend when not using stubs')
+    argp.add_argument(
+            '--render-workers', default=4, type=int,
+            help='Max number of concurrent audio renders')
+    argp.add_argument(
+            '--jobs-running', default=16, type=int,
+            help='Max number of requests served at the same time')
+    argp.add_argument(
+            '--queue-size', default=200, type=int,
+            help='Max number of requests waiting, more are refused')
+    argp.add_argument(
+            '--json',
+            help='Write report to this file')
+    argp.add_argument(
+            '-d', '--debug', action='store_true',
+            help='Show bot log')
+    args = argp.parse_args()
+
+    mix = parse_mix(args.mix)
+    wpm = [int(w) for w in args.wpm.split(',')]
+
+    import text2cw_bot
+    from audiocache import audiocache
+    from renderpool import renderpool
+    from engine import engine
+    from fairqueue import fairqueue
+    from sqlitepersistence import sqlitepersistence
+
+    if not args.debug:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    workdir = tempfile.TemporaryDirectory(prefix='text2cw_loadtest_')
+    backend = args.backend
+    if args.stub:
+        text2cw_bot.EBOOK2CW, text2cw_bot.QSO = write_stubs(
+                                            workdir.name, args.stub_speed)
+        backend = 'ebook2cw'
+
+    api = fakeapi()
+    api.start()
+    jobs = engine()
+    abot = text2cw_bot.bot(
+            backend=backend,
+            cache=audiocache(os.path.join(workdir.name, 'audiocache')),
+            pool=renderpool(args.render_workers),
+            persistence=sqlitepersistence(
+                            os.path.join(workdir.name, 'state.sqlite'),
+                            summary=text2cw_bot.news_settings),
+            jobs=jobs,
+            queue=fairqueue(jobs, args.jobs_running, capacity=args.queue_size),
+            api_url=api.url + '/bot')
+    abot.start(TOKEN)
+
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    monitor = _monitor()
+    monitor.start()
+    results = []
+    start = time.monotonic()
+    deadline = start + args.duration
+    users = [Thread(target=run_user, name='user%i' % i,
+                    args=(api, 1000 + i, mix, wpm, api.url + '/news.xml',
+                          deadline, args.think, results))
+             for i in range(args.users)]
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    elapsed = time.monotonic() - start
+    monitor.stop()
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    usage = {
+        'cpu_user': after.ru_utime - before.ru_utime,
+        'cpu_system': after.ru_stime - before.ru_stime,
+        'cpu_children': children_after.ru_utime + children_after.ru_stime
+        - children.ru_utime - children.ru_stime,
+        'max_rss_mb': after.ru_maxrss / 1024,
+    }
+    stats = {
+        'job queue': abot._queue.stats,
+        'audio cache': abot._audiocache.stats,
+        'renders coalesced': abot._coalesced,
+    }
+
+    api.close()
+    abot.stop()
+    api.stop()
+    workdir.cleanup()
+
+    report = summary(results, elapsed, usage, monitor, api, stats)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=1)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Maintenance of text2cw bot persisted state.
+
+Users are read a batch at a time so memory use does not depend on the
+number of users, stop the bot before running migrate.
+"""
+
+from collections import Counter
+import logging
+
+from sqlitepersistence import sqlitepersistence
+from text2cw_bot import DEFAULTS
+import migrations
+
+# name of the ConversationHandler in text2cw_bot
+CONVERSATION = 'my_conversation'
+
+# settings whose values are not worth a distribution
+UNCOUNTED = ('username', )
+
+
+def do_migrate(db, dry_run=False):
+    counts = Counter()
+
+    def migrate(user_id, data):
+        counts[data.get(migrations.SCHEMA_KEY, 0)] += 1
+        return migrations.migrate(data, DEFAULTS) and not dry_run
+
+    written = db.rewrite_user_data(migrate)
+    for version, n in sorted(counts.items()):
+        print('schema version %i: %i users' % (version, n))
+    if dry_run:
+        print('%i users would be migrated to version %i' % (
+              sum(n for v, n in counts.items() if v < migrations.latest()),
+              migrations.latest()))
+    else:
+        print('%i users migrated to version %i' % (
+              written, migrations.latest()))
+
+
+def _value(value):
+    # lists are not hashable
+    return tuple(value) if isinstance(value, list) else value
+
+
+def do_stats(db, top=5, max_values=1000):
+    users = {False: 0, True: 0}
+    size = {False: 0, True: 0}
+    largest = 0
+    settings = {}   # setting -> Counter of values
+    others = Counter()  # setting -> users with a value not counted
+    for user_id, data, stored, archived in db.iter_user_data():
+        users[archived] += 1
+        size[archived] += stored
+        largest = max(largest, stored)
+        for key, value in data.items():
+            if key in UNCOUNTED:
+                continue
+            values = settings.setdefault(key, Counter())
+            value = _value(value)
+            # keep memory bounded even for free text settings
+            if value in values or len(values) < max_values:
+                values[value] += 1
+            else:
+                others[key] += 1
+
+    total = users[False] + users[True]
+    print('users: %i live, %i archived' % (users[False], users[True]))
+    print('state: %i bytes live, %i bytes archived (compressed), '
+          'average %i, largest %i' % (
+              size[False], size[True],
+              (size[False] + size[True]) / total if total else 0, largest))
+    for key in sorted(settings):
+        values = settings[key]
+        print('%s (%i users):' % (key, sum(values.values()) + others[key]))
+        for value, n in values.most_common(top):
+            print('    %-30s %7i %5.1f%%' % (repr(value), n, 100 * n / total))
+        if others[key]:
+            print('    %-30s %7i' % ('(other values)', others[key]))
+
+
+def do_dump(db, user_ids=None):
+    for user_id, data, stored, archived in db.iter_user_data():
+        if user_ids and user_id not in user_ids:
+            continue
+        print(user_id, '(archived)' if archived else '')
+        print(data)
+        print(db.peek_conversation(CONVERSATION, (user_id, user_id)))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
+    argp = argparse.ArgumentParser(description=__doc__)
+    argp.add_argument(
+            '--state', default='text2cw_bot.sqlite',
+            help='SQLite database of users state')
+    commands = argp.add_subparsers(dest='command', required=True)
+    command = commands.add_parser(
+            'migrate', help='Bring all users to latest schema version')
+    command.add_argument(
+            '-n', '--dry-run', action='store_true',
+            help='Only tell how many users would be migrated')
+    command = commands.add_parser(
+            'stats', help='Print users, state size and settings statistics')
+    command.add_argument(
+            '--top', default=5, type=int,
+            help='Most common values shown for each setting')
+    command = commands.add_parser(
+            'dump', help='Print users state and conversation')
+    command.add_argument(
+            'users', nargs='*', type=int,
+            help='Users to print, all if none given')
+    args = argp.parse_args()
+
+    db = sqlitepersistence(args.state)
+    try:
+        if args.command == 'migrate':
+            do_migrate(db, args.dry_run)
+        elif args.command == 'stats':
+            do_stats(db, args.top)
+        else:
+            do_dump(db, set(args.users))
+    finally:
+        db.close()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Counters and histograms exposed in Prometheus text format.
+
+Metrics are always collected, they cost a lock and a few additions each,
+and are served over HTTP at /metrics only if serve() is called. Gauges are
+read from a callback at scrape time.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from contextlib import contextmanager
+from threading import Thread, Lock
+import bisect
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+SECONDS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+BYTES = tuple(2**n for n in range(10, 26, 2))
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format(name, labels, value):
+    if labels:
+        name += '{%s}' % ','.join(
+            '%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"'))
+            for k, v in labels)
+    return '%s %s' % (name, repr(float(value)))
+
+
+class _metric():
+    def __init__(self, registry, name, help):
+        self._lock = registry._lock
+        self.name = name
+        self.help = help
+        self._values = {}   # labels -> value(s)
+
+
+class counter(_metric):
+    type = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(_labels(labels), 0)
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield _format(self.name + '_total', labels, value)
+
+
+class histogram(_metric):
+    type = 'histogram'
+
+    def __init__(self, registry, name, help, buckets=SECONDS):
+        super().__init__(registry, name, help)
+        self._buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = _labels(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # one count per bucket plus +Inf, then sum
+                counts = self._values[key] = [0] * (len(self._buckets) + 1) \
+                    + [0.0]
+            counts[bisect.bisect_left(self._buckets, value)] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """ Observe seconds spent in the with block """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        with self._lock:
+            counts = self._values.get(_labels(labels))
+            return sum(counts[:-1]) if counts else 0
+
+    def samples(self):
+        for labels, counts in self._values.items():
+            total = 0
+            for le, n in zip(self._buckets + ('+Inf', ), counts):
+                total += n
+                yield _format(self.name + '_bucket',
+                              labels + (('le', le), ), total)
+            yield _format(self.name + '_count', labels, total)
+            yield _format(self.name + '_sum', labels, counts[-1])
+
+
+class gauge(_metric):
+    type = 'gauge'
+
+    def __init__(self, registry, name, help, fn):
+        """ fn returns a number or a dict of labels tuple -> number """
+        super().__init__(registry, name, help)
+        self._fn = fn
+
+    def samples(self):
+        value = self._fn()
+        if not isinstance(value, dict):
+            value = {(): value}
+        for labels, v in value.items():
+            yield _format(self.name, labels, v)
+
+
+class _handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logger.debug('%s - %s' % (self.address_string(), format % args))
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = self.server.metrics.exposition().encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class metrics():
+    def __init__(self, prefix='text2cw_'):
+        self._prefix = prefix
+        self._lock = Lock()
+        self._metrics = []
+        self._httpd = None
+        self._thread = None
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self._add(counter(self, self._prefix + name, help))
+
+    def histogram(self, name, help, buckets=SECONDS):
+        return self._add(histogram(self, self._prefix + name, help, buckets))
+
+    def gauge(self, name, help, fn):
+        return self._add(gauge(self, self._prefix + name, help, fn))
+
+    def exposition(self):
+        """ Return all metrics in Prometheus text format """
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            if isinstance(metric, gauge):
+                # callbacks take their own locks
+                lines.extend(metric.samples())
+            else:
+                with self._lock:
+                    lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, listen='127.0.0.1', port=9464):
+        """ Serve metrics at http://listen:port/metrics """
+        self._httpd = ThreadingHTTPServer((listen, port), _handler)
+        self._httpd.daemon_threads = True
+        self._httpd.metrics = self
+        self._thread = Thread(target=self._httpd.serve_forever,
+                              name='metrics', daemon=True)
+        self._thread.start()
+        logger.info('metrics at http://%s:%i/metrics'
+                    % self._httpd.server_address[:2])
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._thread.join()
+            self._httpd = None
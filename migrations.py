@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Versioned migrations of persisted user_data.
+
+Each migration is registered with the schema version it brings user_data
+to, migrate() applies the ones newer than the version stored in user_data
+so running it again does nothing. Settings missing from user_data are then
+set to their default, a new setting needs a new migration version so
+existing users get it.
+"""
+
+SCHEMA_KEY = 'schema version'
+
+MIGRATIONS = {}     # version -> function changing user_data in place
+_latest = 0         # checked at each message, kept ready
+
+
+def migration(version):
+    """ Register decorated function as migration to given version """
+    def register(fn):
+        if version in MIGRATIONS:
+            raise ValueError("migration %i already registered" % version)
+        global _latest
+        MIGRATIONS[version] = fn
+        _latest = max(MIGRATIONS)
+        return fn
+    return register
+
+
+def latest():
+    """ Return the schema version migrate() brings user_data to """
+    return _latest
+
+
+def migrate(user_data, defaults=None):
+    """
+    Bring user_data to latest schema version, settings in defaults not in
+    user_data are added with their default value
+
+        Returns:
+            changed (bool): True if any migration was applied
+    """
+    version = user_data.get(SCHEMA_KEY, 0)
+    if version >= latest():
+        return False
+    for v in sorted(MIGRATIONS):
+        if v > version:
+            MIGRATIONS[v](user_data)
+    for key, value in (defaults or {}).items():
+        user_data.setdefault(key, value)
+    user_data[SCHEMA_KEY] = latest()
+    return True
+
+
+@migration(1)
+def wpm_to_list(user_data):
+    """ wpm was a single speed before multiple speeds were supported """
+    if isinstance(user_data.get('wpm'), int):
+        user_data['wpm'] = [user_data['wpm']]
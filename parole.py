@@ -1,28 +1,355 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import re
+from collections import OrderedDict
+from collections.abc import Sequence
+from threading import Lock, Event, Thread
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _size(result):
+    # words are decoded from the dictionary for each query, they are not
+    # shared with it
+    return sys.getsizeof(result) + sum(map(sys.getsizeof, result))
+
+
+class anagrammi_cache():
+    """ LRU cache of anagrammi results shared by all dictionaries """
+
+    def __init__(self, max_entries=256, max_bytes=16*2**20):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._lock = Lock()
+        self._entries = OrderedDict()   # key -> result tuple
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            result = self._entries.get(key)
+            if result is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return result
+
+    def put(self, key, result):
+        with self._lock:
+            old = self._entries.get(key)
+            if old is not None:
+                self._bytes -= _size(old)
+            self._bytes += _size(result)
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while self._entries and (len(self._entries) > self._max_entries
+                                     or self._bytes > self._max_bytes):
+                k, old = self._entries.popitem(last=False)
+                self._bytes -= _size(old)
+
+    def invalidate(self, dictionary):
+        """ Drop all results of given dictionary """
+        with self._lock:
+            for key in [k for k in self._entries if k[0] is dictionary]:
+                self._bytes -= _size(self._entries.pop(key))
+
+    @property
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
+
+
+CACHE = anagrammi_cache()
+
+
+MAGIC = b'T2CWDIC2'
+# magic, words, alphabet bytes, blob bytes
+HEADER = struct.Struct('<8sIII')
+
+
+def _align(n):
+    return (n + 7) & ~7
+
+
+def _read_words(filename):
+    with open(filename) as file:
+        lines = file.readlines()
+    return [line.rstrip().upper() for line in lines if line[0] != '#']
+
+
+def _columns(words):
+    """
+    Build the compact representation of a word list
+
+        Returns:
+            alphabet (str): all symbols used, symbol i is mask bit i
+            offsets (numpy.ndarray): word i is blob[offsets[i]:offsets[i+1]-1]
+            lengths (numpy.ndarray): length of each word, sorted
+            masks (numpy.ndarray): set of symbols of each word as bitmask
+            blob (bytes): utf8 encoded words, shortest first, each one
+                          followed by a newline
+    """
+    # sorted by length so words of a given length range are contiguous
+    words = sorted(words, key=len)
+    alphabet = ''.join(sorted(set(''.join(words))))
+    bits = {c: 1 << i for i, c in enumerate(alphabet)}
+    # python ints are needed if symbols don't fit in 64 bits
+    dtype = np.uint64 if len(alphabet) <= 64 else object
+
+    encoded = [w.encode('utf8') + b'\n' for w in words]
+    offsets = np.zeros(len(words) + 1, dtype=np.uint32)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    lengths = np.array([len(w) for w in words], dtype=np.uint16)
+    masks = np.array([_mask(bits, w) for w in words], dtype=dtype)
+    return alphabet, offsets, lengths, masks, b''.join(encoded)
+
+
+def _mask(bits, parola: str):
+    m = 0
+    for c in parola:
+        m |= bits.get(c, 0)
+    return m
+
+
+def compiled_name(filename):
+    return os.path.splitext(filename)[0] + '.dic'
+
+
+def compile_dictionary(filename, destination=None):
+    """
+    Build the compiled, memory mappable, version of a word list file
+
+    File layout is a header followed by alphabet, offsets, lengths and
+    masks columns (each one 8 bytes aligned) and finally the words blob
+    """
+    destination = destination or compiled_name(filename)
+    alphabet, offsets, lengths, masks, blob = _columns(_read_words(filename))
+    if masks.dtype == object:
+        raise ValueError("%s uses more than 64 symbols" % filename)
+    alphabet = alphabet.encode('utf8')
+
+    temp = destination + '.tmp'
+    with open(temp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(lengths), len(alphabet), len(blob)))
+        for data in (alphabet, offsets.tobytes(), lengths.tobytes(),
+                     masks.tobytes()):
+            f.write(data)
+            f.write(b'\0' * (_align(len(data)) - len(data)))
+        f.write(blob)
+    os.replace(temp, destination)
+    return destination
+
+
+def _map(filename):
+    """ Memory map a compiled dictionary and return its columns """
+    with open(filename, 'rb') as f:
+        # pages are read only so they are shared between processes
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, nwords, nalphabet, nblob = HEADER.unpack_from(mm)
+    if magic != MAGIC:
+        raise ValueError("%s is not a compiled dictionary" % filename)
+    pos = HEADER.size
+    alphabet = mm[pos:pos + nalphabet].decode('utf8')
+    pos += _align(nalphabet)
+    columns = []
+    for dtype, count in ((np.uint32, nwords + 1), (np.uint16, nwords),
+                         (np.uint64, nwords)):
+        columns.append(np.frombuffer(mm, dtype=dtype, count=count,
+                                     offset=pos))
+        pos += _align(count * np.dtype(dtype).itemsize)
+    offsets, lengths, masks = columns
+    blob = memoryview(mm)[pos:pos + nblob]
+    return alphabet, offsets, lengths, masks, blob
+
+
+class _parole(Sequence):
+    """ Read only sequence of words decoded on access """
+
+    def __init__(self, dictionary):
+        self._d = dictionary
+
+    def __len__(self):
+        return len(self._d._lengths)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._d._word(j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self._d._word(i)
+
 
 class dizionario():
-    def __init__(self, filename = 'it.txt'):
-        with open(filename) as file:
-            lines = file.readlines()
-        self._parole = [line.rstrip().upper() for line in lines if line[0] != '#']
-        
+    def __init__(self, filename = 'it.txt', cache=CACHE):
+        self._filename = filename
+        self._cache = cache
+        self._load()
+
+    def _load(self):
+        # use compiled dictionary if it is up to date with the text file
+        compiled = compiled_name(self._filename)
+        try:
+            fresh = os.path.getmtime(compiled) >= \
+                os.path.getmtime(self._filename)
+        except OSError:
+            fresh = os.path.exists(compiled)
+        if fresh:
+            columns = _map(compiled)
+        else:
+            logger.info("%s is not compiled, loading text file" %
+                        self._filename)
+            columns = _columns(_read_words(self._filename))
+        alphabet, self._offsets, self._lengths, self._masks, self._blob = \
+            columns
+        self._bits = {c: 1 << i for i, c in enumerate(alphabet)}
+        self._full = (1 << len(alphabet)) - 1
+
+    def reload(self):
+        """ Read dictionary file again dropping any cached result """
+        self._load()
+        if self._cache is not None:
+            self._cache.invalidate(self)
+
+    def _word(self, i):
+        return bytes(self._blob[self._offsets[i]:self._offsets[i+1] - 1]
+                     ).decode('utf8')
+
     @property
     def parole(self):
-        return self._parole
-        
+        return _parole(self)
+
+    @property
+    def cache(self):
+        return self._cache
+
     def anagrammi(self, parola: str, minl=None, maxl=None):
-        chars = ''.join(set(parola)).upper()
-        mi = '%i' % minl if minl is not None else ''
-        ma = '%i' % maxl if maxl is not None else ''
-                
-        regexp = '^[%s]{%s,%s}$' % (re.escape(chars), mi, ma)
-        r = re.compile(regexp)
-        
-        return [ p for p in self._parole if r.match(p) ]
+        """ Return a tuple of words using only chars in parola """
+        # symbols not in dictionary don't change the result so they are
+        # dropped from the cache key
+        charset = ''.join(sorted(c for c in set(parola.upper())
+                                 if c in self._bits))
+        key = (self, charset, minl, maxl)
+        result = self._cache.get(key) if self._cache is not None else None
+        if result is None:
+            result = self._anagrammi(charset, minl, maxl)
+            if self._cache is not None:
+                self._cache.put(key, result)
+        return result
+
+    def _anagrammi(self, charset: str, minl, maxl):
+        # a word can be built with charset if its mask has no symbol out of
+        # charset mask
+        forbidden = self._full & ~_mask(self._bits, charset)
+        if self._masks.dtype != object:
+            forbidden = np.uint64(forbidden)
+
+        # words are sorted by length, so the length range is a slice
+        lo = 0 if minl is None else \
+            np.searchsorted(self._lengths, minl, side='left')
+        hi = len(self._lengths) if maxl is None else \
+            np.searchsorted(self._lengths, maxl, side='right')
+        found = np.flatnonzero((self._masks[lo:hi] & forbidden) == 0)
+        if len(found) * 8 > hi - lo:
+            # many words found, decoding the whole range at once is faster
+            words = bytes(self._blob[self._offsets[lo]:self._offsets[hi]]
+                          ).decode('utf8').split('\n')
+            return tuple(words[i] for i in found.tolist())
+        return tuple(self._word(i) for i in (found + lo).tolist())
+
+
+class registry():
+    """
+    Named dictionaries, each one loaded exactly once
+
+    start() loads all of them in background threads, get() waits for a
+    dictionary to be ready (loading it if nobody did it yet)
+    """
+
+    PENDING, LOADING, READY, FAILED = 'pending', 'loading', 'ready', 'failed'
+
+    def __init__(self, filenames: dict, cache=CACHE):
+        self._filenames = filenames
+        self._cache = cache
+        self._lock = Lock()
+        self._state = {name: self.PENDING for name in filenames}
+        self._dictionaries = {}
+        self._errors = {}
+        self._loaded = {name: Event() for name in filenames}
 
+    def start(self):
+        """ Load all pending dictionaries in background """
+        for name in self._filenames:
+            Thread(target=self._load, args=(name, ), daemon=True,
+                   name='load-' + name).start()
+
+    def _load(self, name):
+        with self._lock:
+            # only one thread loads, failed ones can be tried again
+            if self._state[name] not in (self.PENDING, self.FAILED):
+                return
+            self._state[name] = self.LOADING
+            self._loaded[name].clear()
+        start = time.perf_counter()
+        try:
+            d = dizionario(self._filenames[name], cache=self._cache)
+        except Exception as e:
+            logger.error(msg="Exception loading dictionary %s:" % name,
+                         exc_info=e)
+            with self._lock:
+                self._errors[name] = e
+                self._state[name] = self.FAILED
+        else:
+            logger.info("Dictionary %s (%s) loaded in %.3fs, %i words" % (
+                name, self._filenames[name], time.perf_counter() - start,
+                len(d.parole)))
+            with self._lock:
+                self._dictionaries[name] = d
+                self._errors.pop(name, None)
+                self._state[name] = self.READY
+        self._loaded[name].set()
+
+    def get(self, name, timeout=None):
+        """
+        Return named dictionary, raise TimeoutError if it is not loaded
+        within timeout seconds or the exception raised loading it
+        """
+        with self._lock:
+            state = self._state[name]
+        if state in (self.PENDING, self.FAILED):
+            self._load(name)
+        if not self._loaded[name].wait(timeout):
+            raise TimeoutError("dictionary %s is still loading" % name)
+        with self._lock:
+            if self._state[name] == self.FAILED:
+                raise self._errors[name]
+            return self._dictionaries[name]
+
+    def ready(self, name):
+        with self._lock:
+            return self._state[name] == self.READY
+
+    @property
+    def state(self):
+        with self._lock:
+            return dict(self._state)
 
 if __name__ == "__main__":
     from random import sample, choice
@@ -32,7 +359,6 @@ if __name__ == "__main__":
     print('caricate %i parole' % len(d.parole))
 
     a = d.anagrammi('etani',maxl=10)
-    
-    print('10 anagrammi su %i di etani' % len(a)) 
-    print(sample(a, 10))
 
+    print('10 anagrammi su %i di etani' % len(a))
+    print(sample(a, 10))
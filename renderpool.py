@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Shared limits for audio rendering.
+
+All renders of the bot go through a single pool so the total number of
+concurrent renders is bounded, each request can also be limited to a
+number of renders running at the same time so a single user asking for
+many speeds can't take the whole pool.
+
+Renders are coroutines running on the engine loop, CPU bound ones run on
+the pool threads.
+
+Background renders nobody is waiting for take a slot only when no request
+is waiting for one and at least a worker stays free.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+import asyncio
+import time
+
+BACKGROUND_POLL = 0.1   # s between checks for a free background slot
+
+
+class renderpool():
+    def __init__(self, workers=4, per_request=2):
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='render')
+        self._workers = workers
+        self._renders = asyncio.Semaphore(workers)
+        self._per_request = per_request
+        # renders waiting for and holding a slot, only used on the loop
+        self._waiting = 0
+        self._running = 0
+
+    def map(self, fn, *iterables):
+        """
+        Schedule coroutine fn on each item, return a list of tasks in items
+        order
+
+        Must be called from the loop. fn gets one more argument, an async
+        context manager to enter around the actual render: at most
+        per_request calls are inside it concurrently and the next one enters
+        as soon as one leaves. Work that doesn't render, like waiting for
+        somebody else's render, doesn't take a place of the pool
+        """
+        request = asyncio.Semaphore(self._per_request)
+
+        @asynccontextmanager
+        async def slot():
+            async with request:
+                self._waiting += 1
+                try:
+                    await self._renders.acquire()
+                finally:
+                    self._waiting -= 1
+                try:
+                    self._running += 1
+                    yield
+                finally:
+                    self._running -= 1
+                    self._renders.release()
+
+        return [asyncio.ensure_future(fn(*args, slot))
+                for args in zip(*iterables)]
+
+    @asynccontextmanager
+    async def background(self, deadline):
+        """
+        Slot for a render nobody is waiting for, raise TimeoutError if
+        there is none before deadline (a time.monotonic() value)
+
+        Must be used from the loop
+        """
+        # with a single worker we can only take it when idle
+        while self._waiting or (self._running and
+                                self._running >= self._workers - 1):
+            if time.monotonic() >= deadline:
+                raise TimeoutError('no free render slot')
+            await asyncio.sleep(BACKGROUND_POLL)
+        # never waits, a slot is free and nobody else is waiting for it
+        await self._renders.acquire()
+        try:
+            self._running += 1
+            yield
+        finally:
+            self._running -= 1
+            self._renders.release()
+
+    async def cpu(self, fn, *args, **kwargs):
+        """ Run CPU bound fn on a pool thread """
+        return await asyncio.get_running_loop().run_in_executor(
+                                self._executor, partial(fn, *args, **kwargs))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
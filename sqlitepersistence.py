@@ -0,0 +1,822 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Bot persistence stored in a SQLite database.
+
+Each user, chat and conversation key is a row of its own so a change writes
+just that row, users are read from the database the first time the bot
+needs them and not at startup. Changes are journaled and written to the
+database in batches.
+
+Users idle for a long time can be moved to a separate archive database,
+they are moved back the first time the bot needs them again.
+
+A small summary of each user can be kept in its own column, so questions
+about all users are answered without reading their data.
+
+Run as a script to import an existing PicklePersistence file, archive idle
+users or compact the database.
+"""
+
+from collections import defaultdict
+from threading import RLock, Event, Thread
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import struct
+import time
+import zlib
+
+from telegram.ext import BasePersistence, PicklePersistence
+
+logger = logging.getLogger(__name__)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_data (
+    id INTEGER PRIMARY KEY,
+    data BLOB NOT NULL,
+    active REAL,
+    summary TEXT
+);
+CREATE TABLE IF NOT EXISTS chat_data (
+    id INTEGER PRIMARY KEY,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS bot_data (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    state BLOB NOT NULL,
+    PRIMARY KEY (name, key)
+);
+"""
+
+# archived rows are zlib compressed
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS archive.user_data (
+    id INTEGER PRIMARY KEY,
+    data BLOB NOT NULL,
+    active REAL
+);
+CREATE TABLE IF NOT EXISTS archive.conversations (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    state BLOB NOT NULL,
+    PRIMARY KEY (name, key)
+);
+"""
+
+
+def _dumps(obj):
+    return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+# each journal record is length and crc32 of a pickled change
+RECORD = struct.Struct('<II')
+
+
+def _record(row, blob):
+    data = _dumps((row, blob))
+    return RECORD.pack(len(data), zlib.crc32(data)) + data
+
+
+def _read_journal(filename):
+    """ Return changes in journal, last one wins, torn tail is ignored """
+    changes = {}
+    try:
+        with open(filename, 'rb') as f:
+            journal = f.read()
+    except FileNotFoundError:
+        return changes
+    pos = 0
+    while pos + RECORD.size <= len(journal):
+        size, crc = RECORD.unpack_from(journal, pos)
+        data = journal[pos + RECORD.size:pos + RECORD.size + size]
+        if len(data) < size or zlib.crc32(data) != crc:
+            logger.warning("%s: ignoring incomplete change at %i" % (
+                filename, pos))
+            break
+        row, blob = pickle.loads(data)
+        changes[row] = blob
+        pos += RECORD.size + size
+    return changes
+
+
+class _lazydata(defaultdict):
+    """ user_data/chat_data mapping reading each id on first access """
+
+    def __init__(self, persistence, table):
+        super(_lazydata, self).__init__(dict)
+        self._persistence = persistence
+        self._table = table
+
+    def __missing__(self, key):
+        with self._persistence._lock:
+            # another thread may have loaded it while we were waiting
+            if dict.__contains__(self, key):
+                return dict.__getitem__(self, key)
+            data = self._persistence._load(self._table, key)
+            if data is None:
+                data = self.default_factory()
+            self[key] = data
+            return data
+
+
+class _lazyconversations(dict):
+    """ ConversationHandler states reading each key on first access """
+
+    def __init__(self, persistence, name):
+        super(_lazyconversations, self).__init__()
+        self._persistence = persistence
+        self._name = name
+
+    def __missing__(self, key):
+        with self._persistence._lock:
+            if dict.__contains__(self, key):
+                return dict.__getitem__(self, key)
+            state = self._persistence._load_state(self._name, key)
+            if state is None:
+                raise KeyError(key)
+            self[key] = state
+            return state
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+class sqlitepersistence(BasePersistence):
+    """
+    BasePersistence storing each user, chat and conversation key in its
+    own SQLite row
+
+    Changes are appended to a journal file and kept in memory, they are
+    written to the database in a single transaction every flush_interval
+    seconds or as soon as flush_dirty rows changed. At startup anything
+    left in the journal is written to the database.
+
+    The journal is synced to disk once every sync_journal seconds with all
+    changes made meanwhile (never if 0): a crash of the bot loses nothing,
+    a power loss at most the last sync_journal seconds.
+
+    Stored data must be plain python values, Bot instances are not
+    searched and replaced as in PicklePersistence
+
+    summary(user_data) returns a JSON serializable value stored with each
+    user as it is written, summaries() counts users by summary
+    """
+
+    def __init__(self, filename='text2cw_bot.sqlite', store_user_data=True,
+                 store_chat_data=True, store_bot_data=True,
+                 flush_interval=30, flush_dirty=100, sync_journal=1,
+                 summary=None):
+        super(sqlitepersistence, self).__init__(
+                store_user_data=store_user_data,
+                store_chat_data=store_chat_data,
+                store_bot_data=store_bot_data)
+        self.filename = filename
+        self._flush_interval = flush_interval
+        self._flush_dirty = flush_dirty
+        self._sync_journal = sync_journal
+        self._summary = summary
+        self._lock = RLock()
+        # dispatcher, workers and job queue all update persistence
+        self._db = sqlite3.connect(filename, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # flushes are rare, make each one durable as journal is emptied
+        self._db.execute('PRAGMA synchronous=FULL')
+        self._db.executescript(SCHEMA)
+        columns = [c[1] for c in
+                   self._db.execute('PRAGMA table_info(user_data)')]
+        if 'active' not in columns:
+            # database written before activity tracking, everybody starts
+            # as active now
+            self._db.execute('ALTER TABLE user_data ADD COLUMN active REAL')
+            self._db.execute('UPDATE user_data SET active = ?',
+                             (time.time(), ))
+        if 'summary' not in columns:
+            # NULL is a summary still to compute, see summaries()
+            self._db.execute('ALTER TABLE user_data ADD COLUMN summary TEXT')
+        self._db.execute('CREATE INDEX IF NOT EXISTS user_data_active '
+                         'ON user_data (active)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS user_data_summary '
+                         'ON user_data (summary)')
+        self._db.execute('ATTACH DATABASE ? AS archive',
+                         (filename + '.archive', ))
+        self._db.executescript(ARCHIVE_SCHEMA)
+        self._user_data = None
+        self._chat_data = None
+        self._conversations = {}
+        # hash of what is stored for each loaded row, unchanged data is
+        # not written again
+        self._stored = {}
+        self._dirty = {}    # (table, name, key) -> blob, None to delete
+        self._active = {}   # user id -> last activity not yet written
+        self._unsynced = 0  # journal records not synced to disk yet
+        self.syncs = 0
+        self.synced_changes = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.flush_time = 0.0
+        self.last_flush = {'rows': 0, 'seconds': 0.0}
+        self.max_flush = {'rows': 0, 'seconds': 0.0}
+
+        self._journal_name = filename + '.log'
+        replayed = _read_journal(self._journal_name)
+        if replayed:
+            logger.info("Replaying %i changes from %s" % (
+                len(replayed), self._journal_name))
+            self._apply(replayed.items())
+        self._journal = open(self._journal_name, 'wb')
+
+        self._wake = Event()
+        self._closed = False
+        self._flusher = Thread(target=self._flush_loop, daemon=True,
+                               name='persistence-flush')
+        self._flusher.start()
+
+    # data is never deep copied, see class doc
+    def insert_bot(self, obj):
+        return obj
+
+    @classmethod
+    def replace_bot(cls, obj):
+        return obj
+
+    def _load(self, table, key):
+        with self._lock:
+            if table == 'user_data':
+                self._active[key] = time.time()
+            blob = self._dirty.get((table, None, key))
+            if blob is None:
+                row = self._db.execute(
+                    'SELECT data FROM %s WHERE id = ?' % table, (key, )
+                    ).fetchone()
+                if row is None and table == 'user_data':
+                    row = self._unarchive(
+                        'SELECT data FROM archive.user_data WHERE id = ?',
+                        (key, ),
+                        'INSERT OR IGNORE INTO user_data (id, data, active) '
+                        'VALUES (?, ?, %f)' % time.time(),
+                        'DELETE FROM archive.user_data WHERE id = ?')
+                if row is None:
+                    return None
+                blob = row[0]
+            self._stored[(table, key)] = hash(blob)
+            return pickle.loads(blob)
+
+    def _unarchive(self, select, args, insert, delete):
+        """ Move a row back from archive, return it as in live tables """
+        row = self._db.execute(select, args).fetchone()
+        if row is None:
+            return None
+        row = (zlib.decompress(row[0]), )
+        logger.debug("unarchiving %s" % (args, ))
+        # copy first, a crash in the middle leaves a duplicate and not a
+        # lost row
+        self._db.execute(insert, args + row)
+        self._db.execute(delete, args)
+        return row
+
+    def _load_state(self, name, key):
+        with self._lock:
+            dirty = ('conversations', name, json.dumps(key))
+            if dirty in self._dirty:
+                blob = self._dirty[dirty]
+            else:
+                row = self._db.execute(
+                    'SELECT state FROM conversations '
+                    'WHERE name = ? AND key = ?',
+                    (name, json.dumps(key))).fetchone()
+                if row is None:
+                    row = self._unarchive(
+                        'SELECT state FROM archive.conversations '
+                        'WHERE name = ? AND key = ?',
+                        (name, json.dumps(key)),
+                        'INSERT OR IGNORE INTO conversations '
+                        '(name, key, state) VALUES (?, ?, ?)',
+                        'DELETE FROM archive.conversations '
+                        'WHERE name = ? AND key = ?')
+                blob = row[0] if row is not None else None
+            self._stored[('conversations', (name, json.dumps(key)))] = \
+                hash(blob)
+            return pickle.loads(blob) if blob is not None else None
+
+    def _change(self, row, blob):
+        """ Journal a change and queue it for next flush """
+        with self._lock:
+            # in the OS from now on, synced to disk by the flush thread
+            self._journal.write(_record(row, blob))
+            self._journal.flush()
+            self._unsynced += 1
+            self._dirty[row] = blob
+            if len(self._dirty) >= self._flush_dirty:
+                self._wake.set()
+
+    def _store(self, table, key, data):
+        blob = _dumps(data)
+        with self._lock:
+            if self._stored.get((table, key)) == hash(blob):
+                return
+            self._change((table, None, key), blob)
+            self._stored[(table, key)] = hash(blob)
+
+    def _apply(self, rows, active=None):
+        """
+        Write (table, name, key), blob pairs and user activity times in a
+        single transaction
+        """
+        now = time.time()
+        active = active or {}
+        with self._lock:
+            self._db.execute('BEGIN')
+            try:
+                for (table, name, key), blob in rows:
+                    if table == 'conversations':
+                        if blob is None:
+                            self._db.execute(
+                                'DELETE FROM conversations '
+                                'WHERE name = ? AND key = ?', (name, key))
+                        else:
+                            self._db.execute(
+                                'INSERT OR REPLACE INTO conversations '
+                                '(name, key, state) VALUES (?, ?, ?)',
+                                (name, key, blob))
+                    elif table == 'user_data':
+                        # activity comes only from active, a user never
+                        # seen before starts as active now
+                        self._db.execute(
+                            'INSERT INTO user_data '
+                            '(id, data, active, summary) VALUES (?, ?, ?, ?) '
+                            'ON CONFLICT (id) DO UPDATE SET '
+                            'data = excluded.data, '
+                            'summary = excluded.summary',
+                            (key, blob, active.get(key, now),
+                             self._summary_of(blob)))
+                    else:
+                        self._db.execute(
+                            'INSERT OR REPLACE INTO %s (id, data) '
+                            'VALUES (?, ?)' % table, (key, blob))
+                self._db.executemany(
+                    'UPDATE user_data SET active = ? WHERE id = ?',
+                    ((t, key) for key, t in active.items()))
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def _summary_of(self, blob):
+        if self._summary is None:
+            return None
+        return json.dumps(self._summary(pickle.loads(blob)))
+
+    def summaries(self, batch=1000):
+        """
+        Return (summary, users) pairs for users not archived, summaries
+        missing (old rows, unarchived users...) are computed first
+        """
+        with self._lock:
+            self._flush_dirty_rows()
+        while self._summary is not None:
+            with self._lock:
+                rows = self._db.execute(
+                    'SELECT id, data FROM user_data WHERE summary IS NULL '
+                    'LIMIT ?', (batch, )).fetchall()
+                if not rows:
+                    break
+                self._db.execute('BEGIN')
+                try:
+                    self._db.executemany(
+                        'UPDATE user_data SET summary = ? WHERE id = ?',
+                        [(self._summary_of(blob), user_id)
+                         for user_id, blob in rows])
+                except BaseException:
+                    self._db.execute('ROLLBACK')
+                    raise
+                self._db.execute('COMMIT')
+        with self._lock:
+            return [(json.loads(summary), users)
+                    for summary, users in self._db.execute(
+                        'SELECT summary, COUNT(*) FROM user_data '
+                        'WHERE summary IS NOT NULL GROUP BY summary')]
+
+    def _flush_loop(self):
+        next_flush = time.monotonic() + self._flush_interval
+        while not self._closed:
+            timeout = next_flush - time.monotonic()
+            if self._sync_journal:
+                timeout = min(timeout, self._sync_journal)
+            woken = self._wake.wait(max(timeout, 0))
+            self._wake.clear()
+            try:
+                if woken or time.monotonic() >= next_flush:
+                    next_flush = time.monotonic() + self._flush_interval
+                    self._flush_dirty_rows()
+                else:
+                    self._sync()
+            except Exception as e:
+                # changes are still in journal and memory, retry later
+                logger.error(msg="Exception flushing persistence:",
+                             exc_info=e)
+
+    def _sync(self):
+        """ Sync to disk journal records written since last time """
+        with self._lock:
+            if not self._unsynced:
+                return
+            changes, self._unsynced = self._unsynced, 0
+            fd = self._journal.fileno()
+        # handlers keep journaling while we wait for the disk
+        os.fsync(fd)
+        self.syncs += 1
+        self.synced_changes += changes
+
+    def _flush_dirty_rows(self):
+        with self._lock:
+            if not self._dirty:
+                if self._active:
+                    self._apply((), self._active)
+                    self._active = {}
+                return
+            start = time.perf_counter()
+            rows = len(self._dirty)
+            self._apply(self._dirty.items(), self._active)
+            self._dirty = {}
+            self._active = {}
+            # everything is in the database now
+            self._journal.seek(0)
+            self._journal.truncate()
+            self._unsynced = 0
+            elapsed = time.perf_counter() - start
+            self.flushes += 1
+            self.flushed_rows += rows
+            self.flush_time += elapsed
+            self.last_flush = {'rows': rows, 'seconds': elapsed}
+            if elapsed > self.max_flush['seconds']:
+                self.max_flush = dict(self.last_flush)
+            logger.debug("persistence flushed %i rows in %.3fs" % (
+                rows, elapsed))
+
+    def get_user_data(self):
+        if self._user_data is None:
+            self._user_data = _lazydata(self, 'user_data')
+        return self._user_data
+
+    def get_chat_data(self):
+        if self._chat_data is None:
+            self._chat_data = _lazydata(self, 'chat_data')
+        return self._chat_data
+
+    def get_bot_data(self):
+        data = self._load('bot_data', 0)
+        return data if data is not None else {}
+
+    def get_conversations(self, name):
+        if name not in self._conversations:
+            self._conversations[name] = _lazyconversations(self, name)
+        return self._conversations[name]
+
+    def update_user_data(self, user_id, data):
+        self._store('user_data', user_id, data)
+
+    def update_chat_data(self, chat_id, data):
+        self._store('chat_data', chat_id, data)
+
+    def update_bot_data(self, data):
+        self._store('bot_data', 0, data)
+
+    def update_conversation(self, name, key, new_state):
+        # called after every handler returning a state, even the same one
+        blob = _dumps(new_state) if new_state is not None else None
+        stored = ('conversations', (name, json.dumps(key)))
+        with self._lock:
+            if self._stored.get(stored) == hash(blob):
+                return
+            self._change(('conversations', name, json.dumps(key)), blob)
+            self._stored[stored] = hash(blob)
+
+    def seen(self, user_id):
+        """
+        Record activity of user, persistence updates can't tell as they
+        are also done after each job
+        """
+        with self._lock:
+            self._active[user_id] = time.time()
+
+    def refresh_user_data(self, user_id, user_data):
+        pass
+
+    def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    def refresh_bot_data(self, bot_data):
+        pass
+
+    def flush(self):
+        """ Write all pending changes, called by Updater at stop """
+        with self._lock:
+            self._flush_dirty_rows()
+            self._db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def archive(self, idle):
+        """
+        Move users idle for more than idle seconds to archive
+
+        >>> import tempfile
+        >>> db = sqlitepersistence(os.path.join(tempfile.mkdtemp(), 'db'))
+        >>> users = db.get_user_data()
+        >>> users[1]['wpm'] = 20
+        >>> db.update_user_data(1, users[1])
+        >>> db.flush()
+        >>> time.sleep(0.2)
+        >>> db.update_user_data(1, users[1])   # after a job
+        >>> users[1]['wpm'] = 25
+        >>> db.update_user_data(1, users[1])   # changed, not by the user
+        >>> db.archive(0.1)
+        1
+        >>> db.seen(2)
+        >>> db.update_user_data(2, users[2])
+        >>> db.archive(0.1)
+        0
+        >>> db.close()
+        """
+        with self._lock:
+            # activity and changes must be in the database to be checked
+            self._flush_dirty_rows()
+            ids = [row[0] for row in self._db.execute(
+                'SELECT id FROM user_data WHERE active < ?',
+                (time.time() - idle, ))]
+            idle_ids = set(ids)
+            # conversation keys end with user id
+            conversations = [
+                (name, key, state) for name, key, state in self._db.execute(
+                    'SELECT name, key, state FROM conversations')
+                if json.loads(key)[-1] in idle_ids]
+
+            for i in range(0, len(ids), 1000):
+                chunk = ids[i:i+1000]
+                self._archive_rows(
+                    [(row[0], zlib.compress(row[1]), row[2])
+                     for row in self._db.execute(
+                        'SELECT id, data, active FROM user_data '
+                        'WHERE id IN (%s)' % ','.join('?' * len(chunk)),
+                        chunk)],
+                    'INSERT OR REPLACE INTO archive.user_data '
+                    '(id, data, active) VALUES (?, ?, ?)',
+                    'DELETE FROM user_data WHERE id = ?',
+                    [(i, ) for i in chunk])
+            for i in range(0, len(conversations), 1000):
+                chunk = conversations[i:i+1000]
+                self._archive_rows(
+                    [(name, key, zlib.compress(state))
+                     for name, key, state in chunk],
+                    'INSERT OR REPLACE INTO archive.conversations '
+                    '(name, key, state) VALUES (?, ?, ?)',
+                    'DELETE FROM conversations WHERE name = ? AND key = ?',
+                    [(name, key) for name, key, state in chunk])
+
+            # forget them, they will be read again if they come back
+            for user_id in ids:
+                self._stored.pop(('user_data', user_id), None)
+                if self._user_data is not None:
+                    self._user_data.pop(user_id, None)
+            for name, key, state in conversations:
+                self._stored.pop(('conversations', (name, key)), None)
+                if name in self._conversations:
+                    self._conversations[name].pop(tuple(json.loads(key)),
+                                                  None)
+            logger.info("archived %i users" % len(ids))
+            return len(ids)
+
+    def _archive_rows(self, rows, insert, delete, keys):
+        # copy and commit before deleting, see _unarchive
+        for sql, args in ((insert, rows), (delete, keys)):
+            self._db.execute('BEGIN')
+            try:
+                self._db.executemany(sql, args)
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def iter_user_data(self, batch=1000, archived=True):
+        """
+        Yield user id, data, stored size and archived flag of all users,
+        archived ones are skipped if archived is False
+
+        Users are read batch at a time so memory does not depend on how
+        many they are, data is not cached as with get_user_data()
+        """
+        with self._lock:
+            self._flush_dirty_rows()
+        tables = [('user_data', False)]
+        if archived:
+            tables.append(('archive.user_data', True))
+        for table, in_archive in tables:
+            last = -2**63
+            while True:
+                with self._lock:
+                    rows = self._db.execute(
+                        'SELECT id, data FROM %s WHERE id > ? '
+                        'ORDER BY id LIMIT ?' % table, (last, batch)
+                        ).fetchall()
+                if not rows:
+                    break
+                for user_id, blob in rows:
+                    size = len(blob)
+                    if in_archive:
+                        blob = zlib.decompress(blob)
+                    yield user_id, pickle.loads(blob), size, in_archive
+                last = rows[-1][0]
+
+    def rewrite_user_data(self, fn, batch=1000):
+        """
+        Call fn(user_id, data) for all users, data is written back if it
+        returns True. Return the number of users written
+
+        Only for offline use, users already loaded are not updated
+        """
+        updates = {False: [], True: []}
+        written = 0
+
+        def write(archived):
+            with self._lock:
+                self._db.execute('BEGIN')
+                try:
+                    if archived:
+                        self._db.executemany(
+                            'UPDATE archive.user_data SET data = ? '
+                            'WHERE id = ?', updates[archived])
+                    else:
+                        self._db.executemany(
+                            'UPDATE user_data SET data = ?, summary = ? '
+                            'WHERE id = ?', updates[archived])
+                except BaseException:
+                    self._db.execute('ROLLBACK')
+                    raise
+                self._db.execute('COMMIT')
+            updates[archived].clear()
+
+        for user_id, data, size, archived in self.iter_user_data(batch):
+            if fn(user_id, data):
+                blob = _dumps(data)
+                if archived:
+                    updates[archived].append((zlib.compress(blob), user_id))
+                else:
+                    updates[archived].append(
+                            (blob, self._summary_of(blob), user_id))
+                self._stored.pop(('user_data', user_id), None)
+                written += 1
+                if len(updates[archived]) >= batch:
+                    write(archived)
+        for archived in updates:
+            write(archived)
+        return written
+
+    def peek_conversation(self, name, key):
+        """ Return conversation state without loading or unarchiving it """
+        with self._lock:
+            for table in ('conversations', 'archive.conversations'):
+                row = self._db.execute(
+                    'SELECT state FROM %s WHERE name = ? AND key = ?' % table,
+                    (name, json.dumps(key))).fetchone()
+                if row is not None:
+                    state = row[0]
+                    if table != 'conversations':
+                        state = zlib.decompress(state)
+                    return pickle.loads(state)
+            return None
+
+    def compact(self):
+        """ Rewrite database files dropping unused space """
+        with self._lock:
+            self._flush_dirty_rows()
+            self._db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            before = os.path.getsize(self.filename)
+            self._db.execute('VACUUM main')
+            self._db.execute('VACUUM archive')
+            self._db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            after = os.path.getsize(self.filename)
+            logger.info("%s compacted from %i to %i bytes" % (
+                self.filename, before, after))
+            return before, after
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+        self._flusher.join()
+        with self._lock:
+            self._flush_dirty_rows()
+            self._journal.close()
+            self._db.close()
+
+    @property
+    def stats(self):
+        with self._lock:
+            stats = {
+                table: self._db.execute('SELECT COUNT(*) FROM %s' % table
+                                        ).fetchone()[0]
+                for table in ('user_data', 'chat_data', 'conversations')
+            }
+            stats['archived'] = self._db.execute(
+                'SELECT COUNT(*) FROM archive.user_data').fetchone()[0]
+            stats.update({
+                'dirty': len(self._dirty),
+                'syncs': self.syncs,
+                'avg_sync_batch': self.synced_changes / self.syncs
+                if self.syncs else 0.0,
+                'flushes': self.flushes,
+                'flushed_rows': self.flushed_rows,
+                'avg_batch': self.flushed_rows / self.flushes
+                if self.flushes else 0.0,
+                'avg_flush_seconds': self.flush_time / self.flushes
+                if self.flushes else 0.0,
+                'last_flush': dict(self.last_flush),
+                'max_flush': dict(self.max_flush),
+            })
+            return stats
+
+
+def import_pickle(source='text2cw_bot.data', filename='text2cw_bot.sqlite'):
+    """ Copy all data of a PicklePersistence file in a SQLite database """
+    pp = PicklePersistence(filename=source)
+    user_data = pp.get_user_data()
+    chat_data = pp.get_chat_data()
+    bot_data = pp.get_bot_data()
+    pp.get_conversations('')    # makes sure conversations are loaded
+    conversations = pp.conversations or {}
+
+    rows = [(('user_data', None, k), _dumps(v)) for k, v in user_data.items()]
+    rows += [(('chat_data', None, k), _dumps(v))
+             for k, v in chat_data.items()]
+    if bot_data:
+        rows.append((('bot_data', None, 0), _dumps(bot_data)))
+    rows += [(('conversations', name, json.dumps(key)), _dumps(state))
+             for name, states in conversations.items()
+             for key, state in states.items()]
+
+    db = sqlitepersistence(filename)
+    # a single transaction, much faster than a commit for each row
+    db._apply(rows)
+    stats = db.stats
+    db.close()
+    return stats
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
+    argp = argparse.ArgumentParser(description=__doc__)
+    commands = argp.add_subparsers(dest='command', required=True)
+    command = commands.add_parser(
+            'import', help='Import a PicklePersistence file')
+    command.add_argument(
+            'source', nargs='?', default='text2cw_bot.data',
+            help='PicklePersistence file to import')
+    command.add_argument(
+            'destination', nargs='?', default='text2cw_bot.sqlite',
+            help='SQLite database to write')
+    command = commands.add_parser(
+            'archive', help='Move idle users to archive')
+    command.add_argument(
+            '--days', default=180, type=int,
+            help='Archive users idle for more than this many days')
+    command.add_argument(
+            'database', nargs='?', default='text2cw_bot.sqlite')
+    command = commands.add_parser(
+            'compact', help='Rewrite database dropping unused space')
+    command.add_argument(
+            'database', nargs='?', default='text2cw_bot.sqlite')
+    args = argp.parse_args()
+
+    if args.command == 'import':
+        print('imported %s' % import_pickle(args.source, args.destination))
+    else:
+        db = sqlitepersistence(args.database)
+        if args.command == 'archive':
+            db.archive(args.days * 86400)
+        else:
+            db.compact()
+        print(db.stats)
+        db.close()
@@ -35,31 +35,64 @@ from telegram.ext import Updater, CommandHandler, ConversationHandler, \
     CallbackContext, MessageHandler, Filters, PicklePersistence
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, \
     KeyboardButton, ChatAction, ParseMode
-from telegram.ext.dispatcher import run_async
 from telegram.utils.helpers import escape_markdown
 from telegram.error import BadRequest
 from xhtml2pdf import pisa
 
-import subprocess
-from os import remove, rename
+import tempfile
+import asyncio
+from dataclasses import dataclass, asdict
+from contextlib import nullcontext
+import shutil
+import os
 import re
+import io
 from urllib.parse import urlparse
 import string
 from datetime import datetime
 
 # Remember, to allow repeatability all random functions must be called
 # exclusively from main thread
-from random import sample, choices, choice, seed
+from random import sample, choices, choice, seed, getrandbits
+import numpy as np
+from collections import Counter
 
 # helper function to get latest news from an RSS feed
 import feedparser
+from feedcache import feedcache
 from time import strftime
+import time
 
 # helper functions to convert numbers to text
 from num2text import NumberToText, FindNumbers
 
 # helper word dictionary class
-from parole import dizionario
+from parole import registry
+
+# in process cw synthesizer
+import cwsynth
+
+# rendered audio cache
+from audiocache import audiocache
+
+# shared pool for audio rendering
+from renderpool import renderpool
+
+# event loop running the time consuming jobs
+from engine import engine, run_command
+from fairqueue import fairqueue
+from webhook import webhook
+
+# optional local endpoint with timings and counters
+from metrics import metrics, BYTES
+from contextvars import ContextVar
+# log of requests slower than expected, stage by stage
+import tracing
+from tracing import tracer, span
+
+# per user bot state
+from sqlitepersistence import sqlitepersistence, import_pickle
+import migrations
 
 import logging
 
@@ -72,7 +105,8 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def get_feed(feed_url, last_n=1, news_time=True, title_filter=None):
+def get_feed(feed_url, last_n=1, news_time=True, title_filter=None,
+             feeds=None):
     '''
     Read RSS feed and format a CW message with lates news
 
@@ -81,11 +115,16 @@ def get_feed(feed_url, last_n=1, news_time=True, title_filter=None):
             last_n   (int): number of news to get, 0 for all
             title_filter (str): filter only news with given string in title
                                 case insensitive
+            feeds (feedcache): cache to read feed from, if None feed is
+                               always downloaded
 
         Returns:
             cw_message (str): resulting message or None if any error occours
     '''
-    NewsFeed = feedparser.parse(feed_url)
+    if feeds is not None:
+        NewsFeed = feeds.get(feed_url)
+    else:
+        NewsFeed = feedparser.parse(feed_url)
 
     if NewsFeed.bozo == 0:
         # feeds out there can be malformed so we try to be as safe as possible
@@ -131,10 +170,12 @@ def get_feed(feed_url, last_n=1, news_time=True, title_filter=None):
     return cw_message
 
 
-def safe_file_name(name: str):
-    # remove unsafe char from file name
-    pattern = re.compile(" [^a-zA-Z0-9_]")
-    return pattern.sub('', name)
+def close_audio(future):
+    # audio tasks result is (key, file_id or open file)
+    if not future.cancelled() and future.exception() is None:
+        key, audio = future.result()
+        if not isinstance(audio, str):
+            audio.close()
 
 
 MAIN, TYPING_WPM, TYPING_SNR, TYPING_TONE, TYPING_TITLE, TYPING_FORMAT, \
@@ -187,25 +228,59 @@ do_shuffle = {
 }
 
 
+def gen_groups_batch(charset: str, k: int, n: int):
+    """ Return n exercises of k groups of 5 chars with no char 3 times in a
+    row, repeatable after random.seed()
+    """
+    if len(charset) == 1:
+        # this is a very corner case but with 1 symbol
+        # there's only 1 possible seq
+        return [[charset * 5] * k for i in range(n)]
+    m = len(charset)
+    size = 5 * k
+    rng = np.random.default_rng(getrandbits(64))
+    # drawing each char at random and drawing again one equal to the two
+    # before it is the same as: each char repeats the one before with
+    # probability 1/m unless that one was already a repeat, otherwise it
+    # is one of the other m-1 chars at random
+    # so we draw the candidate repeats and keep every other one in each
+    # sequence of consecutive candidates, starting from the first
+    repeat = rng.random((n, size)) < 1 / m
+    repeat[:, 0] = False
+    column = np.arange(size)
+    last_no = np.maximum.accumulate(np.where(repeat, 0, column), axis=1)
+    repeat &= (column - last_no) % 2 == 1
+    # a char that is not a repeat shifts the previous one by 1..m-1
+    shift = np.where(repeat, 0, rng.integers(1, m, (n, size)))
+    shift[:, 0] = rng.integers(0, m, n)
+    seq = np.cumsum(shift, axis=1) % m
+    chars = np.array(list(charset))[seq]
+    # split in groups of 5 reading each 5 chars as a single string
+    return np.ascontiguousarray(chars).view('<U5').tolist()
+
+
 def gen_groups(charset: str, k: int):
-    # this is a very corner case but with 1 symbol there's only 1 possible seq
+    """ Return k groups of 5 chars with no char 3 times in a row
+
+    For a single exercise of up to about a hundred groups a plain loop is
+    faster than gen_groups_batch(), exercise codes also keep giving the
+    exercise they always gave
+    """
     if len(charset) == 1:
         # this is a very corner case but with 1 symbol
         # there's only 1 possible seq
-        seq = charset[0] * 5 * k
-    else:
-        seq = choices(charset, k=5*k)
-        # avoid more that 2 repeating char
-        for i in range(len(seq)-3):
-            while (seq[i] == seq[i+1] and seq[i+1] == seq[i+2]):
-                seq[i+2] = choice(charset)
-        seq = "".join(seq)
+        return [charset * 5] * k
+    seq = choices(charset, k=5*k)
+    # avoid more that 2 repeating char
+    for i in range(len(seq)-3):
+        while (seq[i] == seq[i+1] and seq[i+1] == seq[i+2]):
+            seq[i+2] = choice(charset)
+    seq = "".join(seq)
     # split in groups of 5
-    groups = [seq[i:i+5] for i in range(0, len(seq), 5)]
-    return groups
+    return [seq[i:i+5] for i in range(0, len(seq), 5)]
 
 
-def create_exercise_pdf(groups, filename: str, wpm, effectivewpm,
+def create_exercise_pdf(groups, output, wpm, effectivewpm,
                         extraspace, charset, exseed):
     # build HTML
     source_html = '''
@@ -280,16 +355,10 @@ def create_exercise_pdf(groups, filename: str, wpm, effectivewpm,
     source_html += '''</body>
           </html>'''
 
-    # open output file for writing (truncated binary)
-    result_file = open(filename, "w+b")
-
     # convert HTML to PDF
     pisa_status = pisa.CreatePDF(
             source_html,                # the HTML to convert
-            dest=result_file)           # file handle to recieve result
-
-    # close output file
-    result_file.close()                 # close output file
+            dest=output)                # file handle to recieve result
 
     # return False on success and True on errors
     return pisa_status.err
@@ -324,9 +393,104 @@ def convert_numbers(s: str):
         s = s[:end] + ' ' + NumberToText(snumber) + ' ' + s[end:]
     return s
 
+
+def prepare_text(text, simplify=False, no_accents=False):
+    """ Clean up text before rendering, same text means same audio """
+    if simplify:
+        text = simplify_text(text)
+    if no_accents:
+        text = translate_accents(text)
+
+    # remove multiple spaces from message
+    text = ' '.join(text.split())
+
+    # remove dangerous chars
+    return text.translate(str.maketrans("#", " "))
+
+
+def audio_titles(title, wpm):
+    """ Return the title of the audio for each speed """
+    if '-wpm-' not in title:
+        # add wpm to end of title if not user supplied
+        title = title + ' -wpm-wpm'
+    # as title can be user supplied be very safe in substitution
+    return [title.replace('-wpm-', str(w)) for w in wpm]
+
+EBOOK2CW = "/usr/bin/ebook2cw"
+QSO = "/usr/bin/QSO"
+
+
+async def ebook2cw_render(pool, text, output, title, author, wpm,
+                          effectivewpm, extraspace, qrq, tone, snr, waveform,
+                          deadline=None):
+    """
+    Render text to mp3 spawning ebook2cw, result is written to output
+
+    TimeoutError is raised if not done by deadline (time.monotonic())
+    """
+    # ebook2cw can only write files, give it a private directory so
+    # concurrent renders can't collide
+    with tempfile.TemporaryDirectory(prefix="text2cw_") as tempdir:
+        # ebook2cw always add chapternumber and extension
+        prefix = os.path.join(tempdir, "cw")
+        command = [EBOOK2CW, "-c", "DONOTSEPARATECHAPTERS",
+                   "-o", prefix, "-u"]
+        command.extend(["-w", str(wpm)])
+        if effectivewpm is not None:
+            command.extend(["-e", str(effectivewpm)])
+        if extraspace is not None:
+            command.extend(["-W", str(extraspace)])
+        if qrq is not None:
+            command.extend(["-Q", str(qrq)])
+        command.extend(["-f", str(tone)])
+        if snr is not None:
+            command.extend(["-N", str(snr)])
+            # add fixed settings for filter and center freq
+            command.extend(["-B", "500", "-C", "800"])
+        command.extend(["-t", title])
+        command.extend(["-a", author])
+        command.extend(["-T", str(ANSWER_WAVEFORM.index(waveform))])
+
+        timeout = deadline - time.monotonic() if deadline is not None \
+            else None
+        await asyncio.wait_for(
+                    run_command(command, input=bytes(text+"\n",
+                                                     encoding='utf8')),
+                    timeout)
+        with open(prefix + "0000.mp3", "rb") as f:
+            shutil.copyfileobj(f, output)
+
+
+async def cwsynth_render(pool, text, output, title, author, wpm,
+                         effectivewpm, extraspace, qrq, tone, snr, waveform,
+                         deadline=None):
+    """ Render text to mp3 with the in process synthesizer """
+    await pool.cpu(cwsynth.render, text, output=output, title=title,
+                   artist=author, wpm=wpm, effectivewpm=effectivewpm,
+                   extraspace=extraspace, qrq=qrq, tone=tone,
+                   snr=snr, bandwidth=500, deadline=deadline,
+                   waveform=ANSWER_WAVEFORM.index(waveform))
+
+
+RENDER_BACKENDS = {
+    'cwsynth': cwsynth_render,
+    'ebook2cw': ebook2cw_render,
+}
+
+
+DICTIONARIES = {
+    'words': 'it.txt',
+    'callsigns': 'callsigns.txt',
+}
+# max time (s) a command waits for a dictionary still loading
+DICTIONARY_TIMEOUT = 5
+
+
 NEWS_FEED = 'https://www.ansa.it/sito/ansait_rss.xml'
 #HOROSCOPE_FEED = 'http://it.horoscopofree.com/rss/horoscopofree-it.rss'
 
+# a new setting needs a new migration (see migrations.py), existing users
+# get its default when they are migrated
 DEFAULTS = {
     'wpm': [25],
     'effectivewpm': None,
@@ -354,11 +518,131 @@ DEFAULTS = {
 }
 
 
+
+@dataclass(frozen=True, slots=True)
+class Settings():
+    """
+    Snapshot of user settings taken when a job is queued
+
+    Jobs get this and not user_data, so they see consistent settings even
+    if the user changes them in the meantime. Fields are DEFAULTS keys, in
+    the same order, with spaces replaced by underscores
+    """
+    wpm: tuple
+    effectivewpm: int
+    tone: int
+    snr: int
+    title: str
+    format: str
+    delmessage: bool
+    feed: str
+    news_to_read: int
+    show_news: bool
+    qrq: int
+    extra_space: int
+    shuffle: str
+    news_time: bool
+    simplify: bool
+    no_accents: bool
+    charset: str
+    groups: int
+    waveform: str
+    convert_numbers: bool
+    groups_prefix: bool
+    word_max: int
+
+    @classmethod
+    def of(cls, user_data):
+        # fields are in DEFAULTS order
+        settings = [user_data.get(key, value)
+                    for key, value in DEFAULTS.items()]
+        settings[0] = tuple(settings[0])    # wpm
+        return cls(*settings)
+
+# user settings which change the audio sent by /read_news
+NEWS_SETTINGS = ['feed', 'news_to_read', 'news_time', 'convert_numbers',
+                 'simplify', 'no_accents', 'wpm', 'effectivewpm',
+                 'extra_space', 'qrq', 'tone', 'snr', 'waveform', 'format',
+                 'title']
+
+
+
+def news_settings(user_data):
+    """
+    Return NEWS_SETTINGS of user as a tuple, None for users not started or
+    not migrated yet (they will be at their next message)
+    """
+    if not user_data.get('exist') or \
+            user_data.get(migrations.SCHEMA_KEY, 0) < migrations.latest():
+        return None
+    settings = Settings.of(user_data)
+    return tuple(getattr(settings, field) for field in NEWS_SETTINGS)
+
+
+# command being served, metrics label for the handler and its jobs
+_command = ContextVar('command', default='background')
+
+
 class bot():
 
-        def __init__(self):
+        def __init__(self, backend='cwsynth', cache=None, pool=None,
+                     spill_size=8*2**20, feeds=None, poll_interval=0,
+                     poll_feeds=(NEWS_FEED, ), poll_top=5, poll_budget=10,
+                     persistence=None, archive_after=0, jobs=None,
+                     queue=None, api_url=None, hook=None, meter=None,
+                     slow_request=10):
             super(bot, self).__init__()
             self._updater = None
+            self._backend = backend
+            self._spill_size = spill_size
+            self._render = RENDER_BACKENDS[backend]
+            self._audiocache = cache if cache is not None else audiocache()
+            self._renderpool = pool if pool is not None else renderpool()
+            self._engine = jobs if jobs is not None else engine()
+            self._queue = queue if queue is not None else \
+                fairqueue(self._engine)
+            self._dictionaries = registry(DICTIONARIES)
+            self._feeds = feeds if feeds is not None else feedcache()
+            self._poll_interval = poll_interval
+            self._poll_feeds = poll_feeds
+            self._poll_top = poll_top
+            self._poll_budget = poll_budget
+            self._polled = {}   # news settings -> feed they were rendered from
+            # audio cache key -> future done when its render ends, only
+            # touched on the engine loop
+            self._rendering = {}
+            self._coalesced = 0     # renders shared instead of repeated
+            self._persistence = persistence
+            self._archive_after = archive_after
+            self._api_url = api_url
+            self._hook = hook
+            self._tracer = tracer(slow_request, details=self._trace_details)
+            self._metrics = meter if meter is not None else metrics()
+            m = self._metrics
+            self._m_requests = m.counter(
+                                'requests', 'Updates handled by command')
+            self._m_errors = m.counter(
+                                'errors', 'Failed updates and jobs by command')
+            self._m_render = m.histogram(
+                                'render_seconds', 'Time to render one audio')
+            self._m_upload = m.histogram(
+                                'upload_seconds', 'Time to send one audio')
+            self._m_upload_bytes = m.histogram(
+                                'upload_bytes', 'Size of uploaded audio',
+                                BYTES)
+            self._m_feed = m.histogram(
+                                'feed_seconds',
+                                'Time to fetch and parse a feed')
+            self._m_pdf = m.histogram(
+                                'pdf_seconds', 'Time to create exercise pdf')
+            self._m_anagrammi = m.histogram(
+                                'anagrammi_seconds', 'Time of anagrammi query')
+            m.gauge('queue_depth', 'Jobs waiting in queue',
+                    lambda: self._queue.stats['depth'])
+            m.gauge('jobs_running', 'Jobs running',
+                    lambda: self._queue.stats['running'])
+            m.gauge('renders_coalesced', 'Renders shared since start',
+                    lambda: self._coalesced)
 
         @property
         def _commands(self):
@@ -675,175 +959,319 @@ class bot():
 
         def _you_exist(self, update: Update, context: CallbackContext):
             if context.user_data and context.user_data['exist']:
-                # check for each setting and set default if needed
-                for (key, value) in DEFAULTS.items():
-                    if self._default(context.user_data, key, value):
-                        update.message.reply_text(
-                            "I now support a new setting, I set it to default "
-                            "for you (%s - %s)" % (key, str(value)))
-                # silently save user name for debugging
-                self._default(context.user_data, 'username',
-                              update.message.from_user.name)
-                # try to update username if we had None previously
-                if update.message.from_user.name is not None and context.user_data['username'] is None:
-                    context.user_data['username'] = update.message.from_user.name
+                if context.user_data.get(migrations.SCHEMA_KEY, 0) < \
+                        migrations.latest():
+                    self._migrate(update, context)
+                # silently save user name for debugging, try to update it
+                # if we had None previously
+                if context.user_data.get('username') is None:
+                    context.user_data['username'] = \
+                        update.message.from_user.name
                 return True
             else:
                 update.message.reply_text("Please use /start to begin")
             return False
 
+        def _migrate(self, update: Update, context: CallbackContext):
+            """ Bring user_data to current version, once for each version """
+            added = [key for key in DEFAULTS if key not in context.user_data]
+            migrations.migrate(context.user_data, DEFAULTS)
+            for key in added:
+                update.message.reply_text(
+                    "I now support a new setting, I set it to default "
+                    "for you (%s - %s)" % (key, str(context.user_data[key])))
+
         # due to persistence command methods cannot be asyncronous
         # (or at least I don't know how to make it in a safe way)
-        # time consuming steps have been isolated and we call them using
-        # run_async()
-        def _reply_with_audio(self, update: Update, context: CallbackContext,
-                              text, reply_markup=None):
-            wpm = context.user_data['wpm']
-            effectivewpm = context.user_data['effectivewpm']
-            extraspace = context.user_data['extra space']
-            tone = context.user_data['tone']
-            snr = context.user_data['snr']
-            title = context.user_data['title']
-            format = context.user_data['format']
-            qrq = context.user_data['qrq']
-            simplify = context.user_data['simplify']
-            no_accents = context.user_data['no accents']
-            waveform = context.user_data['waveform']
-
-            if simplify:
-                    text = simplify_text(text)
-            if no_accents:
-                    text = translate_accents(text)
-
-            # remove multiple spaces from message
-            text = ' '.join(text.split())
-
-            if '-wpm-' not in title:
-                # add wpm to end of title if not user supplied
-                title = title + ' -wpm-wpm'
-
-            for w in wpm:
-                # as title can be user supplied be very safe in substitution
-                t = title.replace('-wpm-', str(w))
-
-                tempfilename = "/tmp/" + \
-                    safe_file_name(update.message.from_user.name) + \
-                    "_" + str(update.message.message_id) + "_" + t
-                command = ["/usr/bin/ebook2cw", "-c", "DONOTSEPARATECHAPTERS",
-                           "-o", tempfilename, "-u"]
-                command.extend(["-w", str(w)])
-                if effectivewpm is not None:
-                    command.extend(["-e", str(effectivewpm)])
-                if extraspace is not None:
-                    command.extend(["-W", str(extraspace)])
-                if qrq is not None:
-                    command.extend(["-Q", str(qrq)])
-                command.extend(["-f", str(tone)])
-                if snr is not None:
-                    command.extend(["-N", str(snr)])
-                    # add fixed settings for filter and center freq
-                    command.extend(["-B", "500", "-C", "800"])
-                command.extend(["-t", t])
-                command.extend(["-a", update.message.from_user.name])
-                command.extend(["-T", str(ANSWER_WAVEFORM.index(waveform))])
-
-                context.bot.send_chat_action(
+        # time consuming steps have been isolated in coroutines and we run
+        # them on the engine with _submit()
+        def _submit(self, update: Update, context: CallbackContext, coro):
+            """
+            Queue coro to run on the engine, errors go to the error handler
+
+            The user is told when the job has to wait or can't be accepted
+            """
+            command = _command.get()
+            trace = tracing.current.get()
+            if trace is not None:
+                trace.hold()
+
+            def on_error(e):
+                self._m_errors.inc(command=command)
+                self._updater.dispatcher.dispatch_error(update, e)
+
+            position = self._queue.submit(
+                update.effective_user.id,
+                self._labelled(command, trace, time.perf_counter(), coro),
+                on_error=on_error)
+            logger.debug('job queue %s', self._queue.stats)
+            if position is None:
+                coro.close()
+                if trace is not None:
+                    trace.release()
+                update.message.reply_text(
+                    "Sorry, I'm too busy right now, please try again in a "
+                    "few minutes",
+                    reply_markup=self._keyboard)
+            elif position:
+                update.message.reply_text(
+                    "I'm busy, your request is number %i in the queue, "
+                    "please wait" % position)
+
+        @staticmethod
+        async def _labelled(command, trace, queued, coro):
+            # jobs may start on the loop thread long after their handler
+            _command.set(command)
+            tracing.current.set(trace)
+            if trace is None:
+                return await coro
+            trace.record('queue', queued, time.perf_counter() - queued)
+            try:
+                return await coro
+            finally:
+                trace.release()
+
+        def _handler(self, command, method):
+            """ Wrap handler method counting and tracing updates """
+            def handler(update: Update, context: CallbackContext):
+                trace = self._tracer.begin(
+                            command, context.user_data,
+                            user=getattr(update.effective_user, 'id', None))
+                tokens = _command.set(command), tracing.current.set(trace)
+                self._m_requests.inc(command=command)
+                if self._persistence is not None and \
+                        update.effective_user is not None:
+                    self._persistence.seen(update.effective_user.id)
+                try:
+                    with span('handler'):
+                        return method(update, context)
+                except Exception:
+                    self._m_errors.inc(command=command)
+                    raise
+                finally:
+                    _command.reset(tokens[0])
+                    tracing.current.reset(tokens[1])
+                    trace.release()
+            return handler
+
+        @staticmethod
+        def _trace_details(trace):
+            # settings the user had when the slow request ended
+            return {'settings': asdict(Settings.of(trace.data))}
+
+        async def _chat_action(self, update: Update, context: CallbackContext,
+                               action):
+            with span('chat_action', action=action):
+                await self._engine.call(
+                                context.bot.send_chat_action,
                                 chat_id=update.effective_message.chat_id,
-                                action=ChatAction.RECORD_AUDIO)
-                # remove dangerous chars
-                text = text.translate(str.maketrans("#", " "))
-                
-                subprocess.run(command,
-                               input=bytes(text+"\n", encoding='utf8'))
-                # ebook2cw always add chapternumber and extension
-                tempfilename += "0000.mp3"
-
+                                action=action)
+
+        async def _reply_with_audio(self, update: Update,
+                                    context: CallbackContext, text, settings,
+                                    reply_markup=None):
+            wpm = settings.wpm
+            effectivewpm = settings.effectivewpm
+            extraspace = settings.extra_space
+            tone = settings.tone
+            snr = settings.snr
+            format = settings.format
+            qrq = settings.qrq
+            waveform = settings.waveform
+
+            with span('prepare_text'):
+                text = prepare_text(text, settings.simplify,
+                                    settings.no_accents)
+            titles = audio_titles(settings.title, wpm)
+
+            await self._chat_action(update, context, ChatAction.RECORD_AUDIO)
+            # all speeds are rendered concurrently but sent in order, each
+            # one as soon as it is ready
+            tasks = self._renderpool.map(
+                lambda w, t, slot: self._prepare_audio(
+                                text, t, context.bot.name, w, effectivewpm,
+                                extraspace, qrq, tone, snr, waveform, format,
+                                slot),
+                wpm, titles)
+            try:
+                for task, t in zip(tasks, titles):
+                    key, audio = await task
+                    await self._engine.call(self._send_audio, update, context,
+                                            key, audio, t, format,
+                                            reply_markup)
+            finally:
+                # do not leak open files if something went wrong
+                for task in tasks:
+                    task.cancel()
+                    task.add_done_callback(close_audio)
+            logger.debug('audio cache %s, %i renders coalesced',
+                         self._audiocache.stats, self._coalesced)
+
+        async def _prepare_audio(self, text, t, author, w, effectivewpm,
+                                 extraspace, qrq, tone, snr, waveform,
+                                 format, slot=nullcontext, deadline=None):
+            """
+            Return cache key and either a file_id or an open file, slot is
+            entered only to render (see renderpool.map), the render is
+            given up with TimeoutError at deadline (time.monotonic())
+            """
+            key = audiocache.key(text, wpm=w, effectivewpm=effectivewpm,
+                                 extraspace=extraspace, tone=tone, snr=snr,
+                                 qrq=qrq, waveform=waveform, format=format,
+                                 title=t, backend=self._backend)
+            audio = self._cached_audio(key)
+            rendering = self._rendering.get(key)
+            if audio is None and rendering is not None:
+                # somebody is rendering the same audio right now, wait for
+                # it and read it from cache (unless that render failed)
+                self._coalesced += 1
+                with span('coalesced', wpm=w):
+                    await asyncio.wait((rendering, ))
+                audio = self._cached_audio(key)
+            if audio is None:
+                rendering = asyncio.get_running_loop().create_future()
+                self._rendering.setdefault(key, rendering)
+                # rendered audio is shared between users so we sign it
+                # with bot name and not with user one
+                # audio stays in memory unless it is really long
+                audio = tempfile.SpooledTemporaryFile(
+                                            max_size=self._spill_size)
+                try:
+                    async with slot():
+                        with self._m_render.time(backend=self._backend,
+                                                 command=_command.get()), \
+                                span('render', wpm=w):
+                            await self._render(self._renderpool, text,
+                                               audio, t, author, w,
+                                               effectivewpm, extraspace, qrq,
+                                               tone, snr, waveform,
+                                               deadline=deadline)
+                    audio = await self._engine.call(self._audiocache.put,
+                                                    key, audio)
+                except BaseException:
+                    audio.close()
+                    raise
+                finally:
+                    if self._rendering.get(key) is rendering:
+                        del self._rendering[key]
+                    rendering.set_result(None)
+            return key, audio
+
+        def _cached_audio(self, key):
+            # best case we already sent it and just need the file_id,
+            # otherwise it may be on disk or we have to render it
+            audio = self._audiocache.file_id(key)
+            if audio is None:
+                audio = self._audiocache.open(key)
+            return audio
+
+        def _send_audio(self, update: Update, context: CallbackContext, key,
+                        audio, t, format, reply_markup=None):
+            with span('chat_action', action=ChatAction.UPLOAD_AUDIO):
                 context.bot.send_chat_action(
                                 chat_id=update.effective_message.chat_id,
                                 action=ChatAction.UPLOAD_AUDIO)
+            message = None
+            command = _command.get()
+            size = 0
+            if not isinstance(audio, str):
+                size = audio.seek(0, io.SEEK_END)
+                self._m_upload_bytes.observe(size, command=command)
+                audio.seek(0)
+            start = time.perf_counter()
+            try:
                 if format == "audio":
-                    newtempfilename = "/tmp/" + \
-                        safe_file_name(update.message.from_user.name) + "_" + t + ".mp3"
-                    rename(tempfilename, newtempfilename)
-                    tempfilename = newtempfilename
-                    update.message.reply_audio(
-                                        audio=open(tempfilename, "rb"),
-                                        title=t,
-                                        reply_markup=reply_markup)
+                    message = update.message.reply_audio(
+                                    audio=audio,
+                                    title=t,
+                                    filename=t + ".mp3",
+                                    reply_markup=reply_markup)
                 else:  # default to voice format
                     try:
-                        update.message.reply_voice(
-                                        voice=open(tempfilename, "rb"),
-                                        caption=t,
-                                        reply_markup=reply_markup)
+                        message = update.message.reply_voice(
+                                    voice=audio,
+                                    caption=t,
+                                    filename=t + ".mp3",
+                                    reply_markup=reply_markup)
                     except BadRequest as e:
                         if e.message == 'Voice_messages_forbidden':
                             update.message.reply_text("Can't send voice to you, please change your privacy settings to allow me")
                         else:
                             raise e
-
-                remove(tempfilename)
-
-        def _do_qso(self, update: Update, context: CallbackContext, show_news):
-            context.bot.send_chat_action(
-                            chat_id=update.effective_message.chat_id,
-                            action=ChatAction.TYPING)
+            finally:
+                if not isinstance(audio, str):
+                    audio.close()
+                self._m_upload.observe(time.perf_counter() - start,
+                                       command=command)
+                trace = tracing.current.get()
+                if trace is not None:
+                    trace.record('upload', start, time.perf_counter() - start,
+                                 title=t, bytes=size)
+
+            attachment = getattr(message, 'effective_attachment', None)
+            if not isinstance(audio, str) and attachment is not None:
+                self._audiocache.set_file_id(key, attachment.file_id)
+
+        async def _do_qso(self, update: Update, context: CallbackContext,
+                          settings):
+            call = self._engine.call
+            await self._chat_action(update, context, ChatAction.TYPING)
             try:
-                command = ["/usr/bin/QSO"]
-                output = subprocess.run(command,
-                                        capture_output=True, text=True)
-                text = output.stdout
+                command = [QSO]
+                text = (await run_command(command)).decode('utf8')
             except:
                 text = None
             if text:
-                if show_news:
-                    context.bot.send_chat_action(
-                            chat_id=update.effective_message.chat_id,
-                            action=ChatAction.TYPING)
-                    update.message.reply_text(
-                            '||'+escape_markdown(text, version=2)+'||',
-                            parse_mode=ParseMode.MARKDOWN_V2)
-                # to avoid possible thread deadlocks we cannot use run_async()
-                self._reply_with_audio(update, context, text,
-                                       reply_markup=self._keyboard)
+                if settings.show_news:
+                    await self._chat_action(update, context, ChatAction.TYPING)
+                    await call(update.message.reply_text,
+                               '||'+escape_markdown(text, version=2)+'||',
+                               parse_mode=ParseMode.MARKDOWN_V2)
+                await self._reply_with_audio(update, context, text, settings,
+                                             reply_markup=self._keyboard)
             else:
-                update.message.reply_text(
+                await call(
+                    update.message.reply_text,
                     "Sorry but something went wrong, you probably hit a bug\n"
                     "Please try again later",
                     reply_markup=self._keyboard)
 
-        def _do_read_news(self, update: Update, context: CallbackContext,
-                          feed, last_n, show_news, convertnumbers,
-                          title_filter=None):
-            news_time = context.user_data['news time']
-            context.bot.send_chat_action(
-                            chat_id=update.effective_message.chat_id,
-                            action=ChatAction.TYPING)
+        async def _do_read_news(self, update: Update,
+                                context: CallbackContext, settings, feed,
+                                last_n, title_filter=None):
+            call = self._engine.call
+            news_time = settings.news_time
+            await self._chat_action(update, context, ChatAction.TYPING)
             last_n = last_n if last_n != 'all' else 0
             try:
-                text = get_feed(feed, last_n, news_time, title_filter)
+                # feedparser blocks, the feed is read on an I/O thread
+                with self._m_feed.time(command=_command.get()), \
+                        span('get_feed', feed=feed):
+                    text = await call(get_feed, feed, last_n, news_time,
+                                      title_filter, feeds=self._feeds)
             except:
                 text = None
             if text:
-                if show_news:
-                    context.bot.send_chat_action(
-                            chat_id=update.effective_message.chat_id,
-                            action=ChatAction.TYPING)
+                if settings.show_news:
+                    await self._chat_action(update, context, ChatAction.TYPING)
                     # send clear text adding a newline after each prosign
                     mtext = re.sub('(<..>)', r'\1\n', text)
                     # split message in 4096 chunks (telegram message limit)
                     for i in range(0, len(mtext), 4096):
-                        update.message.reply_text(
+                        await call(
+                            update.message.reply_text,
                             '||'+escape_markdown(mtext[i:i+4096], version=2)+'||',
                             parse_mode=ParseMode.MARKDOWN_V2
                         )
-                if convertnumbers:
-                    text = convert_numbers(text)
-                # to avoid possible thread deadlocks we cannot use run_async()
-                self._reply_with_audio(update, context, text,
-                                       reply_markup=self._keyboard)
+                logger.debug('feed cache %s', self._feeds.stats)
+                if settings.convert_numbers:
+                    with span('convert_numbers'):
+                        text = convert_numbers(text)
+                await self._reply_with_audio(update, context, text, settings,
+                                             reply_markup=self._keyboard)
             else:
-                update.message.reply_text(
+                await call(
+                    update.message.reply_text,
                     "Sorry but something went wrong and I coudn't read the"
                     " feed\n"
                     "Are you sure you gave me a valid RSS feed URL?\n"
@@ -851,38 +1279,135 @@ class bot():
                     "again",
                     reply_markup=self._keyboard)
 
-        def _do_groups_exercise(self, update: Update, context: CallbackContext,
-                                groups, charset, seed) -> None:
-            wpm = context.user_data['wpm']
-            effectivewpm = context.user_data['effectivewpm']
-            extraspace = context.user_data['extra space']
-            prefix = context.user_data['groups prefix']
+        def _poll_news(self, context: CallbackContext) -> None:
+            """
+            Job pre-rendering news at the settings most users have
+
+            Renders take a place of the render pool only when no user is
+            waiting for one and stop after poll_budget seconds, even in the
+            middle of a render, what is left is done at next poll
+            """
+            deadline = time.monotonic() + self._poll_budget
+            popular = Counter({
+                settings: users
+                for settings, users in self._news_settings(context).items()
+                if settings[0] in self._poll_feeds})
+
+            # download feeds even if nobody reads them, first user will
+            # find them in cache
+            parsed = {feed: self._feeds.get(feed) for feed in self._poll_feeds}
+            rendered = 0
+            for settings, users in popular.most_common(self._poll_top):
+                if self._polled.get(settings) is parsed[settings[0]]:
+                    continue    # feed didn't change since last time
+                done, n = self._prerender_news(context, settings, deadline)
+                rendered += n
+                if not done:
+                    logger.info('news poll out of budget, %i audio ready'
+                                % rendered)
+                    return
+                self._polled[settings] = parsed[settings[0]]
+            # forget settings nobody uses anymore
+            for settings in set(self._polled) - set(popular):
+                del self._polled[settings]
+            logger.debug('news poll done, %i audio ready' % rendered)
+
+        def _news_settings(self, context: CallbackContext):
+            """ Return a Counter of users by news_settings() """
+            if self._persistence is None:
+                # PicklePersistence has everybody in memory, copy them
+                # while dispatcher may be adding new ones
+                while True:
+                    try:
+                        users = list(context.dispatcher.user_data.values())
+                        break
+                    except RuntimeError:
+                        continue
+                return Counter(filter(None, map(news_settings, users)))
+            # summaries stored with each user, JSON made tuples lists
+            return Counter({
+                tuple(tuple(value) if isinstance(value, list) else value
+                      for value in settings): users
+                for settings, users in self._persistence.summaries()
+                if settings is not None})
+
+        def _archive_users(self, context: CallbackContext) -> None:
+            """ Job moving users idle for a long time out of live state """
+            self._persistence.archive(self._archive_after)
+            logger.info('persistence %s' % self._persistence.stats)
+
+        def _prerender_news(self, context: CallbackContext, settings,
+                            deadline):
+            """ Put news in audio cache, return if done and audio count """
+            (feed, last_n, news_time, convertnumbers, simplify, no_accents,
+             wpm, effectivewpm, extraspace, qrq, tone, snr, waveform, format,
+             title) = settings
+            last_n = last_n if last_n != 'all' else 0
+            try:
+                with self._m_feed.time(command=_command.get()):
+                    text = get_feed(feed, last_n, news_time,
+                                    feeds=self._feeds)
+            except Exception as e:
+                logger.warning('news poll of %s failed: %s' % (feed, e))
+                return True, 0
+            if not text:
+                return True, 0
+            if convertnumbers:
+                text = convert_numbers(text)
+            text = prepare_text(text, simplify, no_accents)
+
+            rendered = 0
+            for w, t in zip(wpm, audio_titles(title, wpm)):
+                # at lower priority than users and stopping at deadline
+                # even in the middle of a render
+                prepare = self._prepare_audio(
+                                text, t, context.bot.name, w, effectivewpm,
+                                extraspace, qrq, tone, snr, waveform, format,
+                                lambda: self._renderpool.background(deadline),
+                                deadline)
+                try:
+                    # errors are raised by result(), not logged by engine
+                    key, audio = self._engine.submit(
+                                prepare, on_error=lambda e: None).result()
+                except TimeoutError:
+                    return False, rendered
+                if not isinstance(audio, str):
+                    audio.close()
+                rendered += 1
+            return True, rendered
+
+        async def _do_groups_exercise(self, update: Update,
+                                      context: CallbackContext, settings,
+                                      groups, charset, seed) -> None:
+            call = self._engine.call
+            wpm = settings.wpm
+            effectivewpm = settings.effectivewpm
+            extraspace = settings.extra_space
+            prefix = settings.groups_prefix
 
             for exercise in groups:
                 text = "VVV= " if prefix else ""
                 text += " ".join(exercise)
-                self._reply_with_audio(
+                await self._reply_with_audio(
                                 update,
                                 context,
-                                text)
-
-            context.bot.send_chat_action(
-                        chat_id=update.effective_message.chat_id,
-                        action=ChatAction.TYPING)
-            tempfilename = "/tmp/" + \
-                safe_file_name(update.message.from_user.first_name) +\
-                "_" + str(update.message.message_id) + \
-                "_groups_exercise.pdf"
-            create_exercise_pdf(groups, tempfilename,
+                                text,
+                                settings)
+
+            await self._chat_action(update, context, ChatAction.TYPING)
+            with io.BytesIO() as pdf:
+                with self._m_pdf.time(command=_command.get()), span('pdf'):
+                    await self._renderpool.cpu(
+                                create_exercise_pdf, groups, pdf,
                                 wpm, effectivewpm, extraspace, charset, seed)
-            context.bot.send_chat_action(
-                        chat_id=update.effective_message.chat_id,
-                        action=ChatAction.UPLOAD_DOCUMENT)
-            update.message.reply_document(
-                document=open(tempfilename, "rb"),
-                filename="CW groups exercise.pdf"
-            )
-            remove(tempfilename)
+                pdf.seek(0)
+                await self._chat_action(update, context,
+                                        ChatAction.UPLOAD_DOCUMENT)
+                await call(
+                    update.message.reply_document,
+                    document=pdf,
+                    filename="CW groups exercise.pdf"
+                )
 
         def _cmd_start(self, update: Update, context: CallbackContext) -> None:
             logger.debug('bot._cmd_start')
@@ -894,6 +1419,8 @@ class bot():
             except KeyError:
                 for (key, value) in DEFAULTS.items():
                     self._default(context.user_data, key, value)
+                # new users have nothing to migrate
+                context.user_data[migrations.SCHEMA_KEY] = migrations.latest()
             context.user_data['exist'] = True
 
             update.message.reply_text(
@@ -1083,13 +1610,12 @@ class bot():
                                           + escape_markdown(text, version=2)
                                           + '||',
                                           parse_mode=ParseMode.MARKDOWN_V2)
-                # do the real job in differt thread
-                self._updater.dispatcher.run_async(
-                                    self._reply_with_audio,
+                # do the real job on the engine
+                self._submit(update, context, self._reply_with_audio(
                                     update,
                                     context,
                                     text,
-                                    update=update)
+                                    Settings.of(context.user_data)))
 
         def _cmd_word_max(self, update: Update, context: CallbackContext
                           ) -> None:
@@ -1183,14 +1709,12 @@ class bot():
             else:
                 feed = context.user_data["horoscope feed"]
                 last_n = 1
-                show_news = context.user_data["show news"]
-                convertnumbers = context.user_data['convert numbers']
                 sign = value
-                # do the real job in different thread
-                self._updater.dispatcher.run_async(
-                                    self._do_read_news, update,
-                                    context, feed, last_n, show_news,
-                                    convertnumbers, sign, update=update)
+                # do the real job on the engine
+                self._submit(update, context, self._do_read_news(
+                                    update, context,
+                                    Settings.of(context.user_data),
+                                    feed, last_n, sign))
                 return MAIN
 
         def _send_callsign(self, update: Update, context: CallbackContext
@@ -1207,25 +1731,28 @@ class bot():
                     return None
 
                 try:
-                    d = self._callsign_list
-                except AttributeError:
-                    # try loading dictionary
-                    try:
-                        self._callsign_list = dizionario(filename='callsigns.txt')
-                    except Exception as e:
-                        logger.error(msg="Exception loading callsigns file:",
-                                     exc_info=e)
-                        # notify the user
-                        update.message.reply_text(
-                            "I'm sorry but I could not find the callsigns list,"
-                            " please try again\n"
-                            "If it happens again send a message to my creator"
-                            " @IZ3GME to fix it")
-                        return None
-                    d = self._callsign_list
+                    d = self._dictionaries.get('callsigns',
+                                               timeout=DICTIONARY_TIMEOUT)
+                except TimeoutError:
+                    update.message.reply_text(
+                        "I'm still loading the callsigns list, please try"
+                        " again in a few seconds")
+                    return None
+                except Exception:
+                    # already logged by the registry, notify the user
+                    update.message.reply_text(
+                        "I'm sorry but I could not find the callsigns list,"
+                        " please try again\n"
+                        "If it happens again send a message to my creator"
+                        " @IZ3GME to fix it")
+                    return None
 
+                with self._m_anagrammi.time(command=_command.get()), \
+                        span('anagrammi'):
+                    calls = d.anagrammi(charset)
+                logger.debug('anagrammi cache %s', d.cache.stats)
                 try:
-                    text = " ".join(sample(d.anagrammi(charset), ncall))
+                    text = " ".join(sample(calls, ncall))
                 except IndexError:
                     # no call found, let the user know
                     update.message.reply_text(
@@ -1244,13 +1771,12 @@ class bot():
                                           + escape_markdown(text, version=2)
                                           + '||',
                                           parse_mode=ParseMode.MARKDOWN_V2)
-                # do the real job in differt thread
-                self._updater.dispatcher.run_async(
-                                    self._reply_with_audio,
+                # do the real job on the engine
+                self._submit(update, context, self._reply_with_audio(
                                     update,
                                     context,
                                     text,
-                                    update=update)
+                                    Settings.of(context.user_data)))
 
         def _send_word(self, update: Update, context: CallbackContext
                        ) -> None:
@@ -1267,25 +1793,28 @@ class bot():
                     return None
 
                 try:
-                    d = self._dictionary
-                except AttributeError:
-                    # try loading dictionary
-                    try:
-                        self._dictionary = dizionario()
-                    except Exception as e:
-                        logger.error(msg="Exception loading dictionary file:",
-                                     exc_info=e)
-                        # notify the user
-                        update.message.reply_text(
-                            "I'm sorry but I could not find the dictionary,"
-                            " please try again\n"
-                            "If it happens again send a message to my creator"
-                            " @IZ3GME to fix it")
-                        return None
-                    d = self._dictionary
+                    d = self._dictionaries.get('words',
+                                               timeout=DICTIONARY_TIMEOUT)
+                except TimeoutError:
+                    update.message.reply_text(
+                        "I'm still loading the dictionary, please try again"
+                        " in a few seconds")
+                    return None
+                except Exception:
+                    # already logged by the registry, notify the user
+                    update.message.reply_text(
+                        "I'm sorry but I could not find the dictionary,"
+                        " please try again\n"
+                        "If it happens again send a message to my creator"
+                        " @IZ3GME to fix it")
+                    return None
 
+                with self._m_anagrammi.time(command=_command.get()), \
+                        span('anagrammi'):
+                    words = d.anagrammi(charset, minl=2, maxl=maxl)
+                logger.debug('anagrammi cache %s', d.cache.stats)
                 try:
-                    text = " ".join(sample(d.anagrammi(charset, minl=2, maxl=maxl), nwords))
+                    text = " ".join(sample(words, nwords))
                 except IndexError:
                     # no word found, let the user know
                     update.message.reply_text(
@@ -1306,13 +1835,12 @@ class bot():
                                           + escape_markdown(text, version=2)
                                           + '||',
                                           parse_mode=ParseMode.MARKDOWN_V2)
-                # do the real job in differt thread
-                self._updater.dispatcher.run_async(
-                                    self._reply_with_audio,
+                # do the real job on the engine
+                self._submit(update, context, self._reply_with_audio(
                                     update,
                                     context,
                                     text,
-                                    update=update)
+                                    Settings.of(context.user_data)))
 
         def _groups_exercise(self, update: Update, context: CallbackContext
                              ) -> None:
@@ -1323,16 +1851,18 @@ class bot():
                 if len(context.args) > 0:
                     exseed = " ".join(context.args)
                 if exseed:
+                    # same code, same exercise as it always was
                     seed(exseed)
-                groups = [gen_groups(charset, 12*5) for i in range(3)]
-                if exseed:
+                    groups = [gen_groups(charset, 12*5) for i in range(3)]
                     seed()
-                # do the real job in differt thread
-                self._updater.dispatcher.run_async(
-                                    self._do_groups_exercise,
+                else:
+                    groups = gen_groups_batch(charset, 12*5, 3)
+                # do the real job on the engine
+                self._submit(update, context, self._do_groups_exercise(
                                     update,
                                     context,
-                                    groups, charset, exseed)
+                                    Settings.of(context.user_data),
+                                    groups, charset, exseed))
 
         def _cmd_wpm(self, update: Update, context: CallbackContext) -> None:
             logger.debug('bot._cmd_wpm')
@@ -2186,26 +2716,22 @@ class bot():
                            ) -> None:
             logger.debug('bot._cmd_read_news')
             if self._you_exist(update, context):
-                feed = context.user_data["feed"]
-                last_n = context.user_data["news to read"]
-                show_news = context.user_data["show news"]
-                convertnumbers = context.user_data['convert numbers']
-                # do the real job in different thread
-                self._updater.dispatcher.run_async(
-                                    self._do_read_news, update,
-                                    context, feed, last_n, show_news,
-                                    convertnumbers, update=update)
+                settings = Settings.of(context.user_data)
+                # do the real job on the engine
+                self._submit(update, context, self._do_read_news(
+                                    update, context,
+                                    settings, settings.feed,
+                                    settings.news_to_read))
 
                 return MAIN
 
         def _cmd_qso(self, update: Update, context: CallbackContext) -> None:
             logger.debug('bot._cmd_qso')
             if self._you_exist(update, context):
-                show_news = context.user_data["show news"]
-                # do the real job in different thread
-                self._updater.dispatcher.run_async(
-                                    self._do_qso, update, context, show_news,
-                                    update=update)
+                # do the real job on the engine
+                self._submit(update, context, self._do_qso(
+                                    update, context,
+                                    Settings.of(context.user_data)))
 
                 return MAIN
 
@@ -2247,13 +2773,12 @@ class bot():
                 text = do_shuffle[shuffle](text)
                 if convertnumbers:
                     text = convert_numbers(text)
-                # do the real job in differt thread
-                self._updater.dispatcher.run_async(
-                                    self._reply_with_audio,
+                # do the real job on the engine
+                self._submit(update, context, self._reply_with_audio(
                                     update,
                                     context,
                                     text,
-                                    update=update)
+                                    Settings.of(context.user_data)))
                 if delmessage:
                     update.message.delete()
 
@@ -2271,8 +2796,15 @@ class bot():
                 "to fix it")
 
         def start(self, token):
-            pp = PicklePersistence(filename='text2cw_bot.data')
-            self._updater = Updater(token, persistence=pp, use_context=True,
+            # load word lists in background so no user waits for them
+            self._dictionaries.start()
+            self._engine.start()
+
+            pp = self._persistence
+            if pp is None:
+                pp = PicklePersistence(filename='text2cw_bot.data')
+            self._updater = Updater(token, base_url=self._api_url,
+                                    persistence=pp, use_context=True,
                                     request_kwargs={'read_timeout': 10, })
 
             # tell BotFather my list of commands
@@ -2283,7 +2815,8 @@ class bot():
             self._updater.bot.setMyCommands(commands)
 
             # build conversation handler for each state
-            main_commands = [CommandHandler(command, method)
+            main_commands = [CommandHandler(command,
+                                            self._handler(command, method))
                              for command, description, method, typing_state,
                              accept_method in self._commands if command
                              ]
@@ -2292,10 +2825,13 @@ class bot():
             typing_states = {
                 typing_state: [
                         MessageHandler(
-                            Filters.text & ~Filters.command, accept_method
+                            Filters.text & ~Filters.command,
+                            self._handler(command, accept_method)
                         ),
-                        CommandHandler('leave', self._cmd_leave),
-                        MessageHandler(Filters.all, self._handle_unknown_leave),
+                        CommandHandler('leave', self._handler(
+                                                'leave', self._cmd_leave)),
+                        MessageHandler(Filters.all, self._handler(
+                                'unknown', self._handle_unknown_leave)),
                     ]
                 for command, description, method, typing_state, accept_method
                 in self._commands
@@ -2304,17 +2840,21 @@ class bot():
 
             # build conversation
             conv_handler = ConversationHandler(
-                entry_points=[CommandHandler('start', self._cmd_start)],
+                entry_points=[CommandHandler('start', self._handler(
+                                                'start', self._cmd_start))],
                 states={
                     **typing_states,
                     MAIN: main_commands + [
                         MessageHandler(Filters.text & ~Filters.command,
-                                       self._handle_text),
+                                       self._handler('text',
+                                                     self._handle_text)),
                     ],
                 },
                 fallbacks=[
-                    CommandHandler('stop', self._cmd_stop),
-                    MessageHandler(Filters.all, self._handle_unknown),
+                    CommandHandler('stop', self._handler(
+                                                'stop', self._cmd_stop)),
+                    MessageHandler(Filters.all, self._handler(
+                                            'unknown', self._handle_unknown)),
                 ],
                 name="my_conversation",
                 persistent=True,
@@ -2324,18 +2864,41 @@ class bot():
             self._updater.dispatcher.add_handler(
                             MessageHandler(
                                 Filters.all,
-                                self._handle_unknown
+                                self._handler('unknown', self._handle_unknown)
                                 )
                             )
 
             # ...and the error handler
             self._updater.dispatcher.add_error_handler(self._error_handler)
 
-            self._updater.start_polling(bootstrap_retries=-1)
+            if self._archive_after:
+                self._updater.job_queue.run_repeating(
+                                    self._archive_users, interval=86400,
+                                    first=3600, name='archive users')
+            if self._poll_interval:
+                self._updater.job_queue.run_repeating(
+                                    self._poll_news,
+                                    interval=self._poll_interval, first=10,
+                                    name='news poll')
+
+            if self._hook is not None:
+                self._hook.start(self._updater)
+            else:
+                self._updater.start_polling(bootstrap_retries=-1)
 
         def stop(self):
+            if self._hook is not None:
+                self._hook.stop()
             self._updater.stop()
             self._updater = None
+            if self._persistence is not None:
+                self._persistence.flush()
+                logger.info('persistence %s' % self._persistence.stats)
+            logger.info('job queue %s' % self._queue.stats)
+            logger.info('renders coalesced %i' % self._coalesced)
+            logger.info('traces %s' % self._tracer.stats)
+            self._engine.stop()
+            self._renderpool.shutdown()
 
         def idle(self):
             self._updater.idle()
@@ -2343,7 +2906,6 @@ class bot():
 
 if __name__ == "__main__":
     import argparse
-    import time
 
     argp = argparse.ArgumentParser(description=__doc__)
     argp.add_argument(
@@ -2352,6 +2914,107 @@ if __name__ == "__main__":
     argp.add_argument(
             '-d', '--debug', action='store_true',
             help='Enable debug level log')
+    argp.add_argument(
+            '-b', '--backend', default='cwsynth',
+            choices=RENDER_BACKENDS.keys(),
+            help='Audio rendering backend')
+    argp.add_argument(
+            '--ebook2cw', default=EBOOK2CW,
+            help='ebook2cw executable, for the ebook2cw backend')
+    argp.add_argument(
+            '--qso', default=QSO,
+            help='QSO executable, used by /qso')
+    argp.add_argument(
+            '--cache-dir', default='audiocache',
+            help='Directory for rendered audio cache')
+    argp.add_argument(
+            '--cache-size', default=100, type=int,
+            help='Max size of rendered audio cache (MB)')
+    argp.add_argument(
+            '--render-workers', default=4, type=int,
+            help='Max number of concurrent audio renders')
+    argp.add_argument(
+            '--render-per-request', default=2, type=int,
+            help='Max number of concurrent audio renders for each request')
+    argp.add_argument(
+            '--io-workers', default=8, type=int,
+            help='Threads for blocking calls (uploads, feeds) of all jobs')
+    argp.add_argument(
+            '--jobs-running', default=16, type=int,
+            help='Max number of requests served at the same time')
+    argp.add_argument(
+            '--jobs-per-user', default=2, type=int,
+            help='Max number of requests of a single user served at the '
+                 'same time')
+    argp.add_argument(
+            '--queue-size', default=200, type=int,
+            help='Max number of requests waiting, more are refused')
+    argp.add_argument(
+            '--spill-size', default=8, type=int,
+            help='Rendered audio bigger than this is kept on disk (MB)')
+    argp.add_argument(
+            '--feed-ttl', default=300, type=int,
+            help='Seconds a downloaded feed is used before checking it again')
+    argp.add_argument(
+            '--poll-interval', default=0, type=int,
+            help='Seconds between news polls pre-rendering popular news '
+                 'audio, 0 to disable')
+    argp.add_argument(
+            '--poll-feed', action='append',
+            help='Feed to poll (can be repeated), default is ' + NEWS_FEED)
+    argp.add_argument(
+            '--poll-top', default=5, type=int,
+            help='Pre-render news at this many most used settings')
+    argp.add_argument(
+            '--poll-budget', default=10, type=int,
+            help='Max seconds of rendering for each news poll')
+    argp.add_argument(
+            '--state', default='text2cw_bot.sqlite',
+            help='SQLite database of users state, created importing '
+                 'text2cw_bot.data if it does not exist')
+    argp.add_argument(
+            '--state-flush-interval', default=30, type=int,
+            help='Seconds between writes of changed users state')
+    argp.add_argument(
+            '--state-flush-dirty', default=100, type=int,
+            help='Write users state as soon as this many users changed')
+    argp.add_argument(
+            '--archive-days', default=0, type=int,
+            help='Once a day archive users idle for more than this many '
+                 'days, 0 to never archive')
+    argp.add_argument(
+            '--api-url',
+            help='Bot API base url, default https://api.telegram.org/bot')
+    argp.add_argument(
+            '--webhook-url',
+            help='Receive updates by webhook at this public url instead of '
+                 'polling for them')
+    argp.add_argument(
+            '--webhook-listen', default='127.0.0.1:8443',
+            help='Local address:port of the webhook server, usually behind '
+                 'a reverse proxy')
+    argp.add_argument(
+            '--webhook-path',
+            help='Path served by the webhook server, default is the path '
+                 'of --webhook-url')
+    argp.add_argument(
+            '--webhook-cert',
+            help='Certificate to serve the webhook over HTTPS (sent to '
+                 'telegram too, for self signed ones)')
+    argp.add_argument(
+            '--webhook-key',
+            help='Private key of --webhook-cert')
+    argp.add_argument(
+            '--webhook-secret',
+            help='Secret token telegram must send with updates, random if '
+                 'not given')
+    argp.add_argument(
+            '--slow-request', default=10, type=float,
+            help='Log stages and settings of requests taking longer than '
+                 'this many seconds')
+    argp.add_argument(
+            '--metrics-listen',
+            help='Serve Prometheus metrics at http://address:port/metrics')
     argp.add_argument('token',
                       help='Bot token (ask BotFather)')
     args = argp.parse_args()
@@ -2359,9 +3022,55 @@ if __name__ == "__main__":
     if args.debug:
         logger.setLevel(logging.DEBUG)
     logger.debug("Debug enabled")
+    EBOOK2CW = args.ebook2cw
+    QSO = args.qso
+
+    if args.backend == 'cwsynth' and not cwsynth.available():
+        logger.warning("lameenc not available, falling back to ebook2cw")
+        args.backend = 'ebook2cw'
+
+    if not os.path.exists(args.state) and os.path.exists('text2cw_bot.data'):
+        logger.info("Importing text2cw_bot.data in %s" % args.state)
+        logger.info("Imported %s" % import_pickle('text2cw_bot.data',
+                                                  args.state))
+
+    hook = None
+    if args.webhook_url:
+        listen, port = args.webhook_listen.rsplit(':', 1)
+        hook = webhook(args.webhook_url, listen, int(port),
+                       url_path=args.webhook_path,
+                       secret_token=args.webhook_secret,
+                       cert=args.webhook_cert, key=args.webhook_key)
+
+    meter = metrics()
+    if args.metrics_listen:
+        listen, port = args.metrics_listen.rsplit(':', 1)
+        meter.serve(listen, int(port))
 
     logger.info("Creating bot")
-    abot = bot()
+    jobs = engine(args.io_workers)
+    abot = bot(backend=args.backend,
+               cache=audiocache(args.cache_dir, args.cache_size * 2**20),
+               pool=renderpool(args.render_workers, args.render_per_request),
+               jobs=jobs,
+               queue=fairqueue(jobs, args.jobs_running, args.jobs_per_user,
+                               args.queue_size),
+               spill_size=args.spill_size * 2**20,
+               feeds=feedcache(args.feed_ttl),
+               poll_interval=args.poll_interval,
+               poll_feeds=tuple(args.poll_feed or [NEWS_FEED]),
+               poll_top=args.poll_top,
+               poll_budget=args.poll_budget,
+               persistence=sqlitepersistence(
+                                args.state,
+                                flush_interval=args.state_flush_interval,
+                                flush_dirty=args.state_flush_dirty,
+                                summary=news_settings),
+               archive_after=args.archive_days * 86400,
+               api_url=args.api_url,
+               hook=hook,
+               meter=meter,
+               slow_request=args.slow_request)
     abot.start(args.token)
 
     logger.info("Waiting for %i sec before exiting" % (args.sleep))
@@ -2372,3 +3081,4 @@ if __name__ == "__main__":
 
     logger.info("Done")
     abot.stop()
+    meter.stop()
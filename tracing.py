@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Timed spans of the stages of each request.
+
+A trace is started for each update and made current in a context
+variable, jobs started by the update keep the same trace so their stages
+are recorded too. Spans outside of any trace cost nothing.
+
+The trace ends when the update handler and all its jobs are done, if it
+took longer than the slow threshold it is logged as one JSON line.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+current = ContextVar('trace', default=None)
+
+
+class trace():
+    def __init__(self, tracer, name, data=None, **attrs):
+        self._tracer = tracer
+        self._lock = Lock()
+        self._holds = 1
+        self.name = name
+        self.data = data    # for details(), not logged as is
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.duration = None
+        self.spans = []     # (name, start offset, duration, attrs)
+
+    def record(self, name, start, duration, **attrs):
+        with self._lock:
+            self.spans.append((name, start - self.start, duration, attrs))
+
+    def hold(self):
+        """ Keep trace open until a matching release """
+        with self._lock:
+            self._holds += 1
+
+    def release(self):
+        with self._lock:
+            self._holds -= 1
+            if self._holds:
+                return
+            self.duration = time.perf_counter() - self.start
+        self._tracer.finished(self)
+
+    def as_dict(self):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span[1])
+        return {
+            'request': self.name,
+            'total': round(self.duration, 6),
+            **self.attrs,
+            'spans': [{'stage': name, 'at': round(start, 6),
+                       'took': round(duration, 6), **attrs}
+                      for name, start, duration, attrs in spans],
+        }
+
+
+@contextmanager
+def span(name, **attrs):
+    """ Record the with block as a stage of the current trace """
+    t = current.get()
+    if t is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        t.record(name, start, time.perf_counter() - start, **attrs)
+
+
+class tracer():
+    def __init__(self, slow=10, details=None):
+        """
+        Log traces longer than slow seconds, details(trace) returns a dict
+        of extra information added to the log line
+        """
+        self._slow = slow
+        self._details = details
+        self._lock = Lock()
+        self.traces = 0
+        self.slow = 0
+
+    def begin(self, name, data=None, **attrs):
+        """ Return a new trace, released once by its creator """
+        return trace(self, name, data, **attrs)
+
+    def finished(self, t):
+        with self._lock:
+            self.traces += 1
+            if t.duration < self._slow:
+                return
+            self.slow += 1
+        record = t.as_dict()
+        if self._details is not None:
+            try:
+                record.update(self._details(t))
+            except Exception as e:
+                record['details_error'] = str(e)
+        logger.warning('slow request %s' % json.dumps(record, default=str))
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                'traces': self.traces,
+                'slow': self.slow,
+            }
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Receive telegram updates by webhook instead of long polling.
+
+A small HTTP(S) server accepts the updates telegram POSTs to url_path,
+checks they carry our secret token and puts them in the updater queue so
+the usual dispatcher handles them. When a reverse proxy terminates TLS
+the server can listen on plain HTTP.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Event
+import hmac
+import json
+import logging
+import secrets
+import ssl
+from urllib.parse import urlsplit
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class _handler(BaseHTTPRequestHandler):
+    # set by webhook on the server instance
+    #   server.webhook
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s' % (self.address_string(), format % args))
+
+    def _reply(self, code):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        hook = self.server.webhook
+        if self.path != hook.path:
+            return self._reply(404)
+        token = self.headers.get(SECRET_HEADER, '')
+        if not hmac.compare_digest(token.encode('utf8'),
+                                   hook.secret_token.encode('utf8')):
+            logger.warning('webhook update from %s with bad secret token'
+                           % self.address_string())
+            return self._reply(403)
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            data = json.loads(self.rfile.read(length))
+            update = Update.de_json(data, hook.updater.bot)
+        except (ValueError, TypeError, KeyError):
+            return self._reply(400)
+        hook.updater.update_queue.put(update)
+        hook.received += 1
+        self._reply(200)
+
+
+class webhook():
+    def __init__(self, url, listen='127.0.0.1', port=8443, url_path=None,
+                 secret_token=None, cert=None, key=None,
+                 drop_pending_updates=False, max_connections=40):
+        """
+        url is where telegram has to send updates, listen and port are the
+        address of the local server and url_path the path it accepts, the
+        path of url if not given (a reverse proxy could rewrite it)
+        cert and key enable TLS on the server, cert is also sent to
+        telegram for self signed certificates
+        """
+        self.url = url
+        if url_path is None:
+            url_path = urlsplit(url).path
+        self.path = '/' + url_path.lstrip('/')
+        self.secret_token = secret_token or secrets.token_urlsafe(32)
+        self._listen = listen
+        self._port = port
+        self._cert = cert
+        self._key = key
+        self._drop_pending_updates = drop_pending_updates
+        self._max_connections = max_connections
+        self.updater = None
+        self._httpd = None
+        self._threads = []
+        self.received = 0
+
+    @property
+    def address(self):
+        """ Address the server is listening on """
+        return self._httpd.server_address
+
+    def start(self, updater):
+        """ Start server and dispatcher, then tell telegram our url """
+        self.updater = updater
+        self._httpd = ThreadingHTTPServer((self._listen, self._port),
+                                          _handler)
+        self._httpd.daemon_threads = True
+        self._httpd.webhook = self
+        if self._cert:
+            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            context.load_cert_chain(self._cert, self._key)
+            self._httpd.socket = context.wrap_socket(self._httpd.socket,
+                                                     server_side=True)
+
+        updater.job_queue.start()
+        ready = Event()
+        self._threads = [
+            Thread(target=updater.dispatcher.start, kwargs={'ready': ready},
+                   name='dispatcher'),
+            Thread(target=self._httpd.serve_forever, name='webhook'),
+        ]
+        for thread in self._threads:
+            thread.start()
+        ready.wait()
+        # Updater.idle() and its signal handler look at this
+        updater.running = True
+
+        certificate = open(self._cert, 'rb') if self._cert else None
+        try:
+            updater.bot.set_webhook(
+                        self.url,
+                        certificate=certificate,
+                        max_connections=self._max_connections,
+                        drop_pending_updates=self._drop_pending_updates,
+                        secret_token=self.secret_token)
+        finally:
+            if certificate is not None:
+                certificate.close()
+        logger.info('webhook listening on %s:%i%s' % (
+                    self.address[0], self.address[1], self.path))
+
+    def stop(self):
+        """ Tell telegram to stop sending updates, stop server and dispatcher
+        """
+        if self.updater is None:
+            return
+        try:
+            self.updater.bot.delete_webhook()
+        except Exception as e:
+            logger.warning('could not delete webhook: %s' % e)
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self.updater.running = False
+        self.updater.dispatcher.stop()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        logger.info('webhook received %i updates' % self.received)
+        self.updater = None